@@ -0,0 +1,142 @@
+import os
+import re
+import sys
+import csv
+import json
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from classify_pic_core import (
+    MAX_IMAGE_SIZE, OperationJournal, validate_image_file, commit_image, move_to_error_folder, append_error_log,
+)
+
+BATCH_WORKERS = 16  # 并行移动文件的线程数
+BATCH_CHUNK = 10000  # 每次提交给线程池的映射条数，避免一次创建上百万个任务
+PROGRESS_INTERVAL = 1.0  # 输出进度的间隔（秒）
+# 批量分类单独使用的操作日志：界面会话的日志可能还有未恢复的记录，不能被批量分类整理或删除
+BATCH_JOURNAL_NAME = '.classify_pic_batch_journal.jsonl'
+
+
+# 读取映射文件：CSV（文件名,类别，可带表头）或 JSON（{文件名: 类别} 或 [[文件名, 类别], ...]）
+def load_mapping(mapping_path):
+    if mapping_path.lower().endswith('.json'):
+        with open(mapping_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        pairs = data.items() if isinstance(data, dict) else data
+        return [(str(name), str(category)) for name, category in pairs]
+
+    mapping = []
+    with open(mapping_path, 'r', encoding='utf-8-sig', newline='') as f:
+        for row in csv.reader(f):
+            if len(row) < 2 or not row[0].strip():
+                continue
+            name, category = row[0].strip(), row[1].strip()
+            if not mapping and (name.lower(), category.lower()) in (('filename', 'category'), ('文件名', '类别')):
+                continue
+            mapping.append((name, category))
+    return mapping
+
+
+# 类别只能是一级文件夹名，文件名必须位于待筛选路径之内
+def is_safe_entry(name, category):
+    if not category or category in (os.curdir, os.pardir) or re.search(r'[\\/]', category):
+        return False
+    parts = re.split(r'[\\/]', name)
+    return not os.path.isabs(name) and os.pardir not in parts
+
+
+# 按映射处理一张图片，与界面分类相同：超限或损坏的图片移入错误文件夹，其余直接移动到类别文件夹
+# 返回 'classified' / 'error' / 'missing' / 'invalid'
+def classify_entry(journal, base_path, target_base_path, error_folder, max_image_size, verify, name, category):
+    if not is_safe_entry(name, category):
+        return 'invalid'
+    image_path = os.path.join(base_path, name)
+    if not os.path.isfile(image_path):
+        return 'missing'
+    reason = validate_image_file(image_path, max_image_size, verify)
+    if reason is not None:
+        move_to_error_folder(journal, base_path, name, error_folder)
+        append_error_log(error_folder, name, reason)
+        return 'error'
+
+    save_path = os.path.join(target_base_path, category, name)
+    os.makedirs(os.path.dirname(save_path), exist_ok=True)
+    seq = journal.begin('classify', image_path, save_path, src_orientation=1, orientation=1)
+    restore_orientation = commit_image(image_path, save_path, 1, 1)
+    journal.done(seq, restore_orientation)
+    return 'classified'
+
+
+def print_progress(counts, total, started):
+    processed = sum(counts.values())
+    elapsed = max(time.monotonic() - started, 1e-6)
+    sys.stderr.write(
+        f"\r已处理 {processed}/{total}  分类 {counts['classified']}  错误 {counts['error']}  "
+        f"缺失 {counts['missing']}  无效 {counts['invalid']}  {processed / elapsed:.0f} 张/秒")
+    sys.stderr.flush()
+
+
+def classify_batch(base_path, target_base_path, mapping, max_image_size=MAX_IMAGE_SIZE, workers=BATCH_WORKERS,
+                   verify=False):
+    journal = OperationJournal(target_base_path, BATCH_JOURNAL_NAME)
+    repaired, _ = journal.recover()
+    if repaired:
+        print(f"已处理上次中断时未完成的 {repaired} 个操作", file=sys.stderr)
+
+    error_folder = os.path.join(target_base_path, 'error')
+    os.makedirs(error_folder, exist_ok=True)
+
+    counts = {'classified': 0, 'error': 0, 'missing': 0, 'invalid': 0}
+    started = last_report = time.monotonic()
+
+    def run(entry):
+        name, category = entry
+        try:
+            return classify_entry(journal, base_path, target_base_path, error_folder, max_image_size, verify,
+                                  name, category)
+        except OSError as e:
+            append_error_log(error_folder, name, f"移动失败：{e}")
+            return 'error'
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for start in range(0, len(mapping), BATCH_CHUNK):
+            for result in executor.map(run, mapping[start:start + BATCH_CHUNK]):
+                counts[result] += 1
+                if time.monotonic() - last_report >= PROGRESS_INTERVAL:
+                    print_progress(counts, len(mapping), started)
+                    last_report = time.monotonic()
+    print_progress(counts, len(mapping), started)
+    sys.stderr.write('\n')
+    journal.close()
+    return counts
+
+
+def parse_size(text):
+    width, height = map(int, re.sub(r'[，,]', ',', text).split(','))
+    return width, height
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="无界面批量分类：按映射文件把图片移动到目标路径下的类别文件夹")
+    parser.add_argument('base_path', help="待筛选图片的路径")
+    parser.add_argument('target_base_path', help="图片分类的目标路径")
+    parser.add_argument('mapping', help="映射文件：CSV（文件名,类别）或 JSON（{文件名: 类别}）")
+    parser.add_argument('--max-size', type=parse_size, default=MAX_IMAGE_SIZE,
+                        help="图片最大宽高（格式：宽,高），默认 %d,%d" % MAX_IMAGE_SIZE)
+    parser.add_argument('--workers', type=int, default=BATCH_WORKERS, help="并行线程数")
+    parser.add_argument('--verify', action='store_true', help="用 Image.verify() 检查截断的文件（较慢）")
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.base_path):
+        parser.error("找不到待筛选图片的路径")
+    if not os.path.isdir(args.target_base_path):
+        parser.error("找不到目标路径")
+
+    mapping = load_mapping(args.mapping)
+    counts = classify_batch(args.base_path, args.target_base_path, mapping, args.max_size, args.workers, args.verify)
+    return 0 if counts['error'] == 0 and counts['invalid'] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
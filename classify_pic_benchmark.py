@@ -0,0 +1,296 @@
+# 分类热路径的基准测试：生成可复现的合成图片目录，逐张测量解码、尺寸检查、缩略图、旋转、提交和回滚的耗时
+# 各历史版本（v05…v09、proto）的处理方式在这里按原代码模拟，结果以 JSON 输出，便于跨版本比较
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import argparse
+import tempfile
+import warnings
+
+import PIL
+from PIL import Image
+
+from classify_pic_core import (
+    MAX_IMAGE_SIZE, DISPLAY_SIZE, OPERATION_ORIENTATION, ImageTooLargeError, decode_image, make_preview,
+    compose_orientation, apply_orientation, commit_image, revert_commit, percentile,
+)
+
+BENCH_COUNT = 60  # 默认生成的图片数量
+BENCH_SEED = 0  # 默认随机种子，相同的种子生成相同的目录
+BENCH_FORMATS = ('JPEG', 'PNG', 'BMP', 'GIF')
+NORMAL_SIZES = (640, 1024, 1920, 3000, 4000)  # 正常图片的长边（像素）
+OVERSIZED_SIZES = (8000, 12000)  # 超过最大尺寸的图片的长边，只生成 JPEG/PNG，避免 BMP 过大
+CORRUPT_RATIO = 0.05  # 损坏文件的比例
+OVERSIZED_RATIO = 0.05  # 超限图片的比例
+SCREEN_SIZE = (1920, 1080)  # v05…v09 按屏幕大小生成预览，这里取常见分辨率
+
+STAGES = ('check', 'decode', 'thumbnail', 'transform', 'commit', 'undo')
+
+# 各历史版本的处理方式：
+# full_copy   解码时 img.copy() 整张图片（v08 起），否则 thumbnail 直接作用于打开的文件
+# size_check  解码后比较宽高（v08 起）
+# transform   支持旋转，旋转整张图片后重新生成预览（v08 起）
+# reencode    提交时 current_image.save() 重新编码并删除原文件，否则 shutil.move
+LEGACY_PROFILES = {
+    'v05': dict(full_copy=False, size_check=False, transform=False, reencode=False, display=SCREEN_SIZE,
+                resample=None),
+    'v06': dict(full_copy=False, size_check=False, transform=False, reencode=False, display=SCREEN_SIZE,
+                resample=None),
+    'v07': dict(full_copy=False, size_check=False, transform=False, reencode=False, display=SCREEN_SIZE,
+                resample=None),
+    'v08': dict(full_copy=True, size_check=True, transform=True, reencode=True, display=SCREEN_SIZE, resample=None),
+    'v09': dict(full_copy=True, size_check=True, transform=True, reencode=True, display=SCREEN_SIZE, resample=None),
+    'proto': dict(full_copy=True, size_check=True, transform=True, reencode=True, display=DISPLAY_SIZE,
+                  resample=Image.LANCZOS),
+}
+PROFILES = tuple(LEGACY_PROFILES) + ('current',)
+
+
+# 生成带渐变的 RGB 图片，内容不是纯色，编码和解码的开销接近真实照片
+def synthetic_image(width, height, rng):
+    gradient = Image.linear_gradient('L').resize((width, height), Image.BILINEAR)
+    band = lambda: gradient.rotate(rng.choice((0, 90, 180, 270))).resize((width, height))
+    return Image.merge('RGB', (gradient, band(), band()))
+
+
+# 生成合成图片目录，返回每张图片的说明（文件名、格式、尺寸、类型）
+def generate_corpus(folder, count=BENCH_COUNT, seed=BENCH_SEED, corrupt_ratio=CORRUPT_RATIO,
+                    oversized_ratio=OVERSIZED_RATIO):
+    rng = random.Random(seed)
+    os.makedirs(folder, exist_ok=True)
+    manifest = []
+    for i in range(count):
+        roll = rng.random()
+        kind = 'corrupt' if roll < corrupt_ratio else 'oversized' if roll < corrupt_ratio + oversized_ratio \
+            else 'normal'
+        if kind == 'oversized':
+            image_format = rng.choice(('JPEG', 'PNG'))
+            long_side = rng.choice(OVERSIZED_SIZES)
+        else:
+            image_format = rng.choice(BENCH_FORMATS)
+            long_side = rng.choice(NORMAL_SIZES)
+        size = (long_side, long_side * 3 // 4) if rng.random() < 0.5 else (long_side * 3 // 4, long_side)
+        extension = {'JPEG': 'jpg', 'PNG': 'png', 'BMP': 'bmp', 'GIF': 'gif'}[image_format]
+        name = f"bench_{i:05d}.{extension}"
+        path = os.path.join(folder, name)
+        img = synthetic_image(size[0], size[1], rng)
+        if image_format == 'GIF':
+            img = img.convert('P', palette=Image.ADAPTIVE)
+        params = {}
+        if image_format == 'JPEG':
+            exif = Image.Exif()
+            exif[0x0112] = rng.choice((1, 1, 1, 6, 8, 3))
+            params = dict(quality=90, exif=exif.tobytes())
+        img.save(path, format=image_format, **params)
+        if kind == 'corrupt':
+            # 一半截断文件，一半覆盖成无法识别的内容
+            with open(path, 'r+b') as f:
+                if rng.random() < 0.5:
+                    f.truncate(max(64, os.path.getsize(path) // 3))
+                else:
+                    f.write(bytes(rng.randrange(256) for _ in range(256)))
+        manifest.append({'name': name, 'format': image_format, 'size': list(size), 'kind': kind})
+    with open(os.path.join(folder, 'manifest.json'), 'w', encoding='utf-8') as f:
+        json.dump({'seed': seed, 'count': count, 'images': manifest}, f, ensure_ascii=False, indent=2)
+    return manifest
+
+
+# 按历史版本的代码处理一张图片，返回各阶段耗时（秒）；图片被拒绝时抛出异常
+def run_legacy(profile, image_path, save_path, timings, max_image_size):
+    clock = time.perf_counter
+    start = clock()
+    with Image.open(image_path) as img:
+        if profile['full_copy']:
+            current_image = img.copy()
+            timings['decode'] = clock() - start
+            start = clock()
+            if profile['size_check'] and (current_image.width > max_image_size[0] or
+                                          current_image.height > max_image_size[1]):
+                raise ImageTooLargeError(f"图像 {os.path.basename(image_path)} 超过最大尺寸限制")
+            timings['check'] = clock() - start
+            start = clock()
+            display_img = current_image.copy()
+        else:
+            # v05…v07 直接在打开的文件上生成缩略图，解码包含在 thumbnail 中
+            current_image = None
+            timings['decode'] = clock() - start
+            start = clock()
+            display_img = img
+        if profile['resample'] is None:
+            display_img.thumbnail(profile['display'])
+        else:
+            display_img.thumbnail(profile['display'], profile['resample'])
+        display_img.load()
+        timings['thumbnail'] = clock() - start
+
+    if profile['transform']:
+        start = clock()
+        current_image = current_image.rotate(-90, expand=True)
+        display_img = current_image.copy()
+        if profile['resample'] is None:
+            display_img.thumbnail(profile['display'])
+        else:
+            display_img.thumbnail(profile['display'], profile['resample'])
+        timings['transform'] = clock() - start
+
+    start = clock()
+    if profile['reencode']:
+        current_image.save(save_path)
+        os.remove(image_path)
+    else:
+        shutil.move(image_path, save_path)
+    timings['commit'] = clock() - start
+
+    start = clock()
+    shutil.move(save_path, image_path)
+    timings['undo'] = clock() - start
+
+
+# 按当前版本处理一张图片，直接调用 prepare_image 使用的 decode_image 和 make_preview
+# 尺寸检查在解码时只读文件头完成，计入 decode，不单独统计 check
+def run_current(image_path, save_path, timings, max_image_size, rotate):
+    clock = time.perf_counter
+    start = clock()
+    display_img, base_orientation, _ = decode_image(image_path, max_image_size)
+    timings['decode'] = clock() - start
+
+    start = clock()
+    display_img = make_preview(display_img, base_orientation)
+    timings['thumbnail'] = clock() - start
+
+    orientation = base_orientation
+    if rotate:
+        start = clock()
+        orientation = compose_orientation(orientation, 'right')
+        display_img = apply_orientation(display_img, OPERATION_ORIENTATION['right'])
+        timings['transform'] = clock() - start
+
+    start = clock()
+    restore_orientation = commit_image(image_path, save_path, base_orientation, orientation)
+    timings['commit'] = clock() - start
+
+    start = clock()
+    revert_commit(image_path, save_path, restore_orientation, orientation)
+    timings['undo'] = clock() - start
+
+
+def summarize(values):
+    values = sorted(values)
+    if not values:
+        return {'count': 0}
+    return {
+        'count': len(values),
+        'mean_ms': round(sum(values) / len(values) * 1000, 3),
+        'p50_ms': round(percentile(values, 50) * 1000, 3),
+        'p95_ms': round(percentile(values, 95) * 1000, 3),
+        'p99_ms': round(percentile(values, 99) * 1000, 3),
+        'max_ms': round(values[-1] * 1000, 3),
+    }
+
+
+# 在语料的副本上运行一个版本，返回汇总结果
+def run_profile(name, corpus, work_folder, max_image_size=MAX_IMAGE_SIZE, rotate=True):
+    source = os.path.join(work_folder, name, 'source')
+    target = os.path.join(work_folder, name, 'target')
+    shutil.copytree(corpus, source, ignore=shutil.ignore_patterns('manifest.json'))
+    os.makedirs(target)
+    stages = {stage: [] for stage in STAGES}
+    totals = []
+    rejected = {}
+    started = time.perf_counter()
+    for image_name in sorted(os.listdir(source)):
+        image_path = os.path.join(source, image_name)
+        save_path = os.path.join(target, image_name)
+        timings = {}
+        try:
+            if name == 'current':
+                run_current(image_path, save_path, timings, max_image_size, rotate)
+            else:
+                profile = dict(LEGACY_PROFILES[name])
+                profile['transform'] = profile['transform'] and rotate
+                run_legacy(profile, image_path, save_path, timings, max_image_size)
+        except Exception as e:
+            rejected[image_name] = type(e).__name__
+        for stage, seconds in timings.items():
+            stages[stage].append(seconds)
+        totals.append(sum(timings.values()))
+    elapsed = time.perf_counter() - started
+    shutil.rmtree(os.path.join(work_folder, name), ignore_errors=True)
+    return {
+        'images': len(totals),
+        'rejected': len(rejected),
+        'rejected_by_type': {kind: list(rejected.values()).count(kind) for kind in sorted(set(rejected.values()))},
+        'elapsed_s': round(elapsed, 3),
+        'images_per_s': round(len(totals) / elapsed, 2) if elapsed else None,
+        'per_image': summarize(totals),
+        'stages': {stage: summarize(values) for stage, values in stages.items()},
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="分类热路径基准测试，结果以 JSON 输出")
+    parser.add_argument('--profiles', default=','.join(PROFILES),
+                        help="要测试的版本，逗号分隔，可选：" + ','.join(PROFILES))
+    parser.add_argument('--count', type=int, default=BENCH_COUNT, help="生成的图片数量")
+    parser.add_argument('--seed', type=int, default=BENCH_SEED, help="随机种子")
+    parser.add_argument('--corrupt', type=float, default=CORRUPT_RATIO, help="损坏文件的比例")
+    parser.add_argument('--oversized', type=float, default=OVERSIZED_RATIO, help="超限图片的比例")
+    parser.add_argument('--corpus', help="语料目录；不存在时生成，存在时直接使用（可在多次运行间复用）")
+    parser.add_argument('--no-rotate', action='store_true', help="不测量旋转，提交时直接移动文件")
+    parser.add_argument('--output', help="结果写入该文件，默认输出到标准输出")
+    args = parser.parse_args(argv)
+
+    profiles = [name.strip() for name in args.profiles.split(',') if name.strip()]
+    unknown = [name for name in profiles if name not in PROFILES]
+    if unknown:
+        parser.error(f"未知的版本：{','.join(unknown)}")
+
+    work_folder = tempfile.mkdtemp(prefix='classify_pic_bench_')
+    try:
+        corpus = args.corpus or os.path.join(work_folder, 'corpus')
+        if not os.path.isdir(corpus):
+            print(f"正在生成 {args.count} 张测试图片……", file=sys.stderr)
+            generate_corpus(corpus, args.count, args.seed, args.corrupt, args.oversized)
+        else:
+            # 复用已有语料时以其中的说明为准
+            with open(os.path.join(corpus, 'manifest.json'), encoding='utf-8') as f:
+                manifest = json.load(f)
+            args.count, args.seed = manifest['count'], manifest['seed']
+        # 旧版本会完整解码超限图片，这里只统计耗时，不输出解压炸弹警告
+        warnings.simplefilter('ignore', Image.DecompressionBombWarning)
+        results = {}
+        for name in profiles:
+            print(f"正在测试 {name}……", file=sys.stderr)
+            results[name] = run_profile(name, corpus, work_folder, rotate=not args.no_rotate)
+    finally:
+        shutil.rmtree(work_folder, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'pillow': PIL.__version__,
+            'platform': platform.platform(),
+            'count': args.count,
+            'seed': args.seed,
+            'corrupt_ratio': args.corrupt,
+            'oversized_ratio': args.oversized,
+            'rotate': not args.no_rotate,
+            'max_image_size': list(MAX_IMAGE_SIZE),
+        },
+        'profiles': results,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,2079 @@
+# 图片分类的核心功能，与界面无关：扫描、校验、方向处理、提交与回滚、预览图缓存、操作日志和会话进度
+# 图形界面（classify_pic_v10_ultimate.py）和无界面批量分类（classify_pic_batch.py）共用
+import os
+import io
+import json
+import math
+import shutil
+import sqlite3
+import struct
+import tempfile
+import time
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait
+from itertools import repeat
+from queue import Queue, Empty
+from PIL import Image
+
+try:
+    import numpy as np
+except ImportError:  # 没有 NumPy 时不查找重复图片
+    np = None
+
+MAX_IMAGE_SIZE = (5000, 5000)
+
+DISPLAY_SIZE = (900, 900)  # 固定的显示尺寸
+
+IMAGE_EXTENSIONS = ('png', 'jpg', 'jpeg', 'gif', 'bmp')
+
+SCAN_BATCH_SIZE = 500  # 后台扫描每批提交给界面的文件数
+
+ERROR_LOG_NAME = 'error_log.txt'  # 错误文件夹中记录坏图片原因的日志
+
+VALIDATE_PARALLEL_MIN = 200  # 图片数达到该值时预扫描才启用多进程
+VALIDATE_CHUNK_SIZE = 64  # 每个进程一次领取的图片数
+
+THUMBNAIL_CACHE_PATH = 'thumbnail_cache.sqlite'  # 预览图缓存文件，与 categories.json 放在一起
+THUMBNAIL_CACHE_MB = 1024  # 预览图缓存的大小上限，为 0 时不使用缓存
+
+PREVIEW_CACHE_MB = 256  # 内存中保留最近显示过的预览图的上限
+
+PREFETCH_DEPTH = 3  # 后台预读取的图片数量
+
+DRAFT_PREVIEW = True  # JPEG 预览使用 draft 模式按 1/2、1/4、1/8 比例快速解码
+
+TIERED_PREVIEW = True  # 预读取未完成时先显示粗略预览，LANCZOS 预览在后台完成后再替换
+COARSE_DRAFT_SCALE = 4  # JPEG 粗略预览按显示尺寸的 1/4 用 draft 解码（libjpeg 实际按 1/8 缩小），再放大显示
+EXIF_PLACEHOLDER = True  # 有内嵌 EXIF 缩略图的 JPEG 先显示缩略图，不必等待解码
+PREFETCH_WAIT = 0.05  # 当前图片正在预读取时最多等待的秒数，超时后才生成占位预览，避免同一文件解码两次
+
+UNDO_MEMORY_MB = 256  # 回滚记录中预览图占用内存的上限，超出部分转存到临时目录
+UNDO_SPILL_MB = 2048  # 临时目录中预览图的上限，超出后只保留方向信息，回滚时重新读取文件
+
+JOURNAL_NAME = '.classify_pic_journal.jsonl'  # 操作日志文件名，保存在目标路径下
+JOURNAL_SYNC_EVERY = 32  # 每写入多少条日志强制落盘一次
+JOURNAL_SYNC_INTERVAL = 1.0  # 距上次落盘超过多少秒时强制落盘
+
+SESSION_NAME = '.classify_pic_session.json'  # 会话进度文件名，保存在目标路径下
+
+DEFAULT_TARGETS = ['有问题', '没有问题']  # 未自定义分类时使用的类别
+
+LATENCY_WINDOW = 1000  # 每个阶段保留最近多少次耗时用于计算百分位数
+RATE_WINDOW = 20  # 按最近多少次分类计算每分钟张数
+TRACE_NAME = 'classify_pic_trace.json'  # 性能跟踪文件名，保存在目标路径下
+TRACE_MAX_EVENTS = 200000  # 跟踪文件最多保留的事件数
+
+COMMIT_QUEUE_SIZE = 64  # 后台写入队列的上限，超过时分类操作等待写入完成
+
+DUPLICATE_GROUPING = True  # 计算感知哈希，提示并可一键分类重复图片（需要 NumPy）
+DUPLICATE_DISTANCE = 6  # 64 位哈希的汉明距离不超过该值视为重复
+DUPLICATE_WORKERS = max(1, (os.cpu_count() or 2) - 1)  # 计算哈希的进程数，留一个核给界面和预读取
+HASH_CHUNK_SIZE = 64  # 每个进程一次计算的图片数
+
+
+# 自定义异常
+class ImageTooLargeError(Exception):
+    pass
+
+
+# 用 os.scandir 流式扫描图片，逐个返回相对 base_path 的路径；exclude 中的目录不会进入
+def scan_images(base_path, recursive=False, exclude=()):
+    pending_dirs = ['']
+    while pending_dirs:
+        rel_dir = pending_dirs.pop()
+        try:
+            with os.scandir(os.path.join(base_path, rel_dir)) as entries:
+                for entry in entries:
+                    name = os.path.join(rel_dir, entry.name) if rel_dir else entry.name
+                    try:
+                        is_dir = entry.is_dir(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    if is_dir:
+                        if recursive and not any(same_path(entry.path, path) for path in exclude):
+                            pending_dirs.append(name)
+                    elif entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                        yield name
+        except OSError:
+            continue
+
+
+# 后台扫描线程：按批把扫描结果放入队列，界面线程定时取出，扫描到第一张图片即可开始分类
+class ImageScanner:
+    def __init__(self, base_path, recursive=False, exclude=()):
+        self.results = Queue()
+        self.finished = False
+        self.stopped = False
+        self.thread = threading.Thread(target=self._run, args=(base_path, recursive, exclude), daemon=True)
+        self.thread.start()
+
+    def _run(self, base_path, recursive, exclude):
+        batch = []
+        first = True
+        for name in scan_images(base_path, recursive, exclude):
+            if self.stopped:
+                return
+            batch.append(name)
+            # 第一张图片立即提交，之后按批提交
+            if first or len(batch) >= SCAN_BATCH_SIZE:
+                self.results.put(batch)
+                batch = []
+                first = False
+        if batch:
+            self.results.put(batch)
+        self.finished = True
+
+    # 取出目前已扫描到的全部文件
+    def drain(self):
+        names = []
+        while True:
+            try:
+                names.extend(self.results.get_nowait())
+            except Empty:
+                return names
+
+    def stop(self):
+        self.stopped = True
+
+
+# 待分类队列：数组 + 删除标记 + 游标，前进、回滚、删除和跳转都是 O(1)（均摊），与队列长度无关
+class WorkQueue:
+    def __init__(self, names=()):
+        self.items = []
+        self.alive = bytearray()
+        self.positions = {}  # 文件名 -> 在 items 中的位置
+        self.front = []  # 回滚放回的图片（栈顶最先显示），优先于游标处的图片
+        self.cursor = 0
+        self.alive_count = 0
+        self.done = 0  # 已处理的图片数，用于显示进度
+        self.extend(names)
+
+    def __len__(self):
+        return len(self.front) + self.alive_count
+
+    def extend(self, names):
+        for name in names:
+            self.positions[name] = len(self.items)
+            self.items.append(name)
+        added = len(self.items) - len(self.alive)
+        self.alive.extend(b'\x01' * added)
+        self.alive_count += added
+
+    # 把游标移到下一张未处理的图片；到达末尾时从头查找跳转时越过的图片
+    def _seek(self):
+        if self.alive_count == 0:
+            return
+        while self.cursor < len(self.items) and not self.alive[self.cursor]:
+            self.cursor += 1
+        if self.cursor >= len(self.items):
+            self.cursor = self.alive.index(1)
+
+    def current(self):
+        if self.front:
+            return self.front[-1]
+        if self.alive_count == 0:
+            return None
+        self._seek()
+        return self.items[self.cursor]
+
+    # 移出当前图片（分类完成或移入错误文件夹）
+    def pop_current(self):
+        if self.front:
+            name = self.front.pop()
+        else:
+            name = self.current()
+            if name is None:
+                return None
+            self._kill(self.cursor)
+        self.done += 1
+        return name
+
+    def _kill(self, position):
+        self.alive[position] = 0
+        self.alive_count -= 1
+        del self.positions[self.items[position]]
+
+    # 提交失败的图片放回队尾，稍后重新分类
+    def requeue(self, name):
+        self.extend([name])
+        self.done = max(0, self.done - 1)
+
+    # 回滚：把图片放回队首作为当前图片
+    def push_front(self, name):
+        self.front.append(name)
+        self.done = max(0, self.done - 1)
+
+    def __contains__(self, name):
+        return name in self.positions or name in self.front
+
+    # 移出任意一张尚未处理的图片，done 为 True 时计入已处理数（与当前图片一起分类的重复图片）
+    def remove(self, name, done=False):
+        position = self.positions.get(name)
+        if position is not None and self.alive[position]:
+            self._kill(position)
+        elif name in self.front:
+            self.front.remove(name)
+        else:
+            return False
+        if done:
+            self.done += 1
+        return True
+
+    # 跳转到原始顺序中的第 position 张图片，回滚放回的图片移到队尾
+    def jump(self, position):
+        self.extend(reversed(self.front))
+        self.front.clear()
+        self.cursor = max(0, min(position, len(self.items) - 1))
+        self._seek()
+
+    # 返回从当前图片开始、跳过 skip 张后的 count 张待处理图片
+    def peek(self, count, skip=0):
+        names = list(reversed(self.front))[:skip + count]
+        position = self.cursor
+        while len(names) < skip + count and position < len(self.items):
+            if self.alive[position]:
+                names.append(self.items[position])
+            position += 1
+        return names[skip:]
+
+    # 按显示顺序列出全部待处理图片，用于保存会话进度
+    def pending(self):
+        names = list(reversed(self.front))
+        names.extend(self.items[i] for i in range(self.cursor, len(self.items)) if self.alive[i])
+        names.extend(self.items[i] for i in range(min(self.cursor, len(self.items))) if self.alive[i])
+        return names
+
+
+# 检查图片尺寸是否超限（仅比较文件头中的宽高，不解码像素）
+def check_image_size(img, image_path, max_image_size):
+    if img.width > max_image_size[0] or img.height > max_image_size[1]:
+        raise ImageTooLargeError(f"图像 {os.path.basename(image_path)} 超过最大尺寸限制")
+
+
+# 只读取文件头校验图片，超限或损坏时抛出异常
+def check_image_header(image_path, max_image_size):
+    with Image.open(image_path) as img:
+        check_image_size(img, image_path, max_image_size)
+
+
+# 校验单个文件（可在子进程中运行），通过时返回 None，否则返回原因
+# verify 为 True 时额外用 Image.verify() 检查文件是否被截断
+def validate_image_file(image_path, max_image_size, verify=False):
+    try:
+        check_image_header(image_path, max_image_size)
+        if verify:
+            with Image.open(image_path) as img:
+                img.verify()
+    except Exception as e:
+        return str(e)
+    return None
+
+
+# 预扫描：在分类开始前统计将被移入错误文件夹的图片，图片较多时用多进程并行校验
+def prescan_images(base_path, images, max_image_size, verify=False, workers=None):
+    paths = [os.path.join(base_path, image_name) for image_name in images]
+    if len(paths) < VALIDATE_PARALLEL_MIN:
+        results = map(validate_image_file, paths, repeat(max_image_size), repeat(verify))
+        return [(name, reason) for name, reason in zip(images, results) if reason is not None]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(validate_image_file, paths, repeat(max_image_size), repeat(verify),
+                               chunksize=VALIDATE_CHUNK_SIZE)
+        return [(name, reason) for name, reason in zip(images, results) if reason is not None]
+
+
+# 方向处理：用 EXIF 方向值（1-8，二面体群的 8 个元素）记录图片的朝向
+EXIF_THUMBNAIL_OFFSET_TAG = 0x0201  # IFD1 中内嵌缩略图的偏移
+EXIF_THUMBNAIL_LENGTH_TAG = 0x0202  # IFD1 中内嵌缩略图的长度
+EXIF_ORIENTATION_TAG = 0x0112
+
+# EXIF 方向值 -> 使原始像素正确显示所需的 Pillow 变换
+ORIENTATION_TRANSPOSE = {
+    1: None,
+    2: Image.FLIP_LEFT_RIGHT,
+    3: Image.ROTATE_180,
+    4: Image.FLIP_TOP_BOTTOM,
+    5: Image.TRANSPOSE,
+    6: Image.ROTATE_270,
+    7: Image.TRANSVERSE,
+    8: Image.ROTATE_90,
+}
+
+# EXIF 方向值 -> 坐标变换矩阵 (a, b, c, d)，x 向右、y 向下
+_ORIENTATION_MATRIX = {
+    1: (1, 0, 0, 1),
+    2: (-1, 0, 0, 1),
+    3: (-1, 0, 0, -1),
+    4: (1, 0, 0, -1),
+    5: (0, 1, 1, 0),
+    6: (0, -1, 1, 0),
+    7: (0, -1, -1, 0),
+    8: (0, 1, -1, 0),
+}
+_MATRIX_ORIENTATION = {matrix: orientation for orientation, matrix in _ORIENTATION_MATRIX.items()}
+
+# 操作键对应的方向变换：A 逆时针、D 顺时针、W 垂直翻转、S 水平翻转
+OPERATION_ORIENTATION = {
+    'left': 8,
+    'right': 6,
+    'vertical': 4,
+    'horizontal': 2,
+}
+
+
+# 在已有方向的基础上再执行一次变换，返回组合后的方向值
+def compose_orientation(orientation, operation):
+    a, b, c, d = _ORIENTATION_MATRIX[OPERATION_ORIENTATION.get(operation, operation)]
+    e, f, g, h = _ORIENTATION_MATRIX[orientation]
+    return _MATRIX_ORIENTATION[(a * e + b * g, a * f + b * h, c * e + d * g, c * f + d * h)]
+
+
+# 求出从 base 方向变换到 target 方向所需的方向值
+def relative_orientation(base, target):
+    for orientation in ORIENTATION_TRANSPOSE:
+        if compose_orientation(base, orientation) == target:
+            return orientation
+
+
+def apply_orientation(img, orientation):
+    method = ORIENTATION_TRANSPOSE[orientation]
+    return img if method is None else img.transpose(method)
+
+
+def read_orientation(img):
+    orientation = img.getexif().get(EXIF_ORIENTATION_TAG, 1)
+    return orientation if orientation in ORIENTATION_TRANSPOSE else 1
+
+
+# 定位 JPEG 文件中的 EXIF 段：返回 (段起始位置, 段总长度, EXIF 数据)，没有 EXIF 时返回 (可插入位置, 0, None)
+def _find_jpeg_exif(f):
+    f.seek(0)
+    if f.read(2) != b'\xff\xd8':
+        raise ValueError("不是 JPEG 文件")
+    insert_pos = 2
+    while True:
+        pos = f.tell()
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF or marker[1] in (0xD9, 0xDA):
+            return insert_pos, 0, None
+        length = struct.unpack('>H', f.read(2))[0]
+        if marker[1] == 0xE1:
+            payload = f.read(length - 2)
+            if payload.startswith(b'Exif\x00\x00'):
+                return pos, length + 2, payload
+        else:
+            f.seek(length - 2, os.SEEK_CUR)
+        if marker[1] == 0xE0 and pos == 2:
+            # EXIF 段放在 JFIF 段之后
+            insert_pos = f.tell()
+
+
+# 在 EXIF 数据中查找 IFD0 的方向标签，返回其值在 EXIF 数据中的偏移和字节序
+def _find_orientation_value(payload):
+    tiff = payload[6:]
+    endian = {b'II': '<', b'MM': '>'}.get(tiff[:2])
+    if endian is None:
+        return None, None
+    ifd0 = struct.unpack(endian + 'I', tiff[4:8])[0]
+    count = struct.unpack(endian + 'H', tiff[ifd0:ifd0 + 2])[0]
+    for i in range(count):
+        entry = ifd0 + 2 + 12 * i
+        tag, value_type, value_count = struct.unpack(endian + 'HHI', tiff[entry:entry + 8])
+        if tag == EXIF_ORIENTATION_TAG and value_type == 3 and value_count == 1:
+            return 6 + entry + 8, endian
+    return None, None
+
+
+# 在 EXIF 数据中查找 IFD1 记录的内嵌缩略图（JPEGInterchangeFormat/JPEGInterchangeFormatLength），返回其 JPEG 数据
+def _find_exif_thumbnail(payload):
+    tiff = payload[6:]
+    endian = {b'II': '<', b'MM': '>'}.get(tiff[:2])
+    if endian is None:
+        return None
+    ifd0 = struct.unpack(endian + 'I', tiff[4:8])[0]
+    count = struct.unpack(endian + 'H', tiff[ifd0:ifd0 + 2])[0]
+    ifd1 = struct.unpack(endian + 'I', tiff[ifd0 + 2 + 12 * count:ifd0 + 6 + 12 * count])[0]
+    if not ifd1:
+        return None
+    values = {}
+    count = struct.unpack(endian + 'H', tiff[ifd1:ifd1 + 2])[0]
+    for i in range(count):
+        entry = ifd1 + 2 + 12 * i
+        tag, value_type = struct.unpack(endian + 'HH', tiff[entry:entry + 4])
+        if tag in (EXIF_THUMBNAIL_OFFSET_TAG, EXIF_THUMBNAIL_LENGTH_TAG):
+            value_format = endian + ('I' if value_type == 4 else 'H')
+            values[tag] = struct.unpack_from(value_format, tiff, entry + 8)[0]
+    offset = values.get(EXIF_THUMBNAIL_OFFSET_TAG)
+    length = values.get(EXIF_THUMBNAIL_LENGTH_TAG)
+    if not offset or not length:
+        return None
+    data = tiff[offset:offset + length]
+    return data if len(data) == length and data.startswith(b'\xff\xd8') else None
+
+
+# 读取 JPEG 内嵌的 EXIF 缩略图，只读取文件开头的 EXIF 段；没有时返回 None
+def read_exif_thumbnail(image_path):
+    with open(image_path, 'rb') as f:
+        try:
+            _, _, payload = _find_jpeg_exif(f)
+        except (ValueError, struct.error):
+            return None
+    if payload is None:
+        return None
+    try:
+        return _find_exif_thumbnail(payload)
+    except struct.error:
+        return None
+
+
+# 无损修改 JPEG 的 EXIF 方向并移动到 dst：
+# 已有方向标签时原地改写 2 个字节后重命名，否则重写 EXIF 段（不重新编码像素）
+def write_jpeg_orientation(src, dst, orientation):
+    with open(src, 'r+b') as f:
+        pos, length, payload = _find_jpeg_exif(f)
+        if payload is not None:
+            offset, endian = _find_orientation_value(payload)
+            if offset is not None:
+                f.seek(pos + 4 + offset)
+                f.write(struct.pack(endian + 'H', orientation))
+                patched = True
+            else:
+                patched = False
+        else:
+            patched = False
+        if not patched:
+            exif = Image.Exif()
+            if payload is not None:
+                exif.load(payload[6:])
+            exif[EXIF_ORIENTATION_TAG] = orientation
+            data = exif.tobytes()
+            if not data.startswith(b'Exif\x00\x00'):
+                data = b'Exif\x00\x00' + data
+            f.seek(0)
+            content = f.read()
+            content = content[:pos] + b'\xff\xe1' + struct.pack('>H', len(data) + 2) + data + content[pos + length:]
+    if patched:
+        move_file(src, dst)
+        return
+    tmp_path = dst + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(content)
+    replace_synced(tmp_path, dst)
+    if os.path.abspath(src) != os.path.abspath(dst):
+        os.remove(src)
+
+
+# 临时文件先落盘再原子替换为目标文件：恢复时把“目标文件存在”视为写入完成，断电后也必须成立
+def replace_synced(tmp_path, dst):
+    with open(tmp_path, 'rb+') as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_path, dst)
+
+
+def is_jpeg_file(path):
+    with open(path, 'rb') as f:
+        return f.read(2) == b'\xff\xd8'
+
+
+# 把图片按指定方向提交到 save_path：
+# 方向未变时直接移动；JPEG 改写 EXIF 方向标签；其他格式才解码并重新编码像素
+# 返回撤销时需要恢复的方向值（无法无损恢复时为 None）
+def commit_image(image_path, save_path, base_orientation, orientation):
+    if orientation == base_orientation:
+        move_file(image_path, save_path)
+        return base_orientation
+    if is_jpeg_file(image_path):
+        try:
+            write_jpeg_orientation(image_path, save_path, orientation)
+            return base_orientation
+        except (ValueError, struct.error):
+            pass
+    full_image = load_full_image(image_path)
+    exif = full_image.getexif()
+    if EXIF_ORIENTATION_TAG in exif:
+        exif[EXIF_ORIENTATION_TAG] = 1
+    params = {}
+    if exif:
+        params['exif'] = exif.tobytes()
+    if full_image.info.get('icc_profile'):
+        params['icc_profile'] = full_image.info['icc_profile']
+    # 先写临时文件再替换，保证目标文件存在时一定是完整的
+    image_format = Image.registered_extensions().get(os.path.splitext(save_path)[1].lower())
+    tmp_path = save_path + '.tmp'
+    apply_orientation(full_image, orientation).save(tmp_path, format=image_format, **params)
+    replace_synced(tmp_path, save_path)
+    os.remove(image_path)
+    return None
+
+
+# 撤销 commit_image：把文件移回原位置，并在可能时恢复原来的方向标签
+def revert_commit(image_path, save_path, restore_orientation, orientation):
+    if restore_orientation is None or restore_orientation == orientation:
+        move_file(save_path, image_path)
+    else:
+        write_jpeg_orientation(save_path, image_path, restore_orientation)
+
+
+# 解码完整分辨率图片（仅在需要重新编码时调用）
+def load_full_image(image_path):
+    with Image.open(image_path) as img:
+        return img.copy()
+
+
+def image_nbytes(img):
+    return img.width * img.height * len(img.getbands())
+
+
+# 持久化的预览图缓存（SQLite），以 文件名+大小+修改时间 为键
+# 移动文件不改变大小和修改时间，因此分类后再复查目标文件夹时仍能命中；超出容量时淘汰最久未使用的条目
+class ThumbnailCache:
+    def __init__(self, path=THUMBNAIL_CACHE_PATH, max_mb=THUMBNAIL_CACHE_MB):
+        self.max_bytes = max_mb * 1024 * 1024
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=OFF")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS thumbnails ("
+            "key TEXT PRIMARY KEY, width INTEGER, height INTEGER, orientation INTEGER, "
+            "data BLOB, size INTEGER, last_used REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS thumbnails_last_used ON thumbnails (last_used)")
+        self.total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM thumbnails").fetchone()[0]
+
+    @staticmethod
+    def make_key(image_path):
+        stat = os.stat(image_path)
+        return f"{os.path.basename(image_path)}|{stat.st_size}|{stat.st_mtime_ns}"
+
+    # 返回 (原图宽, 原图高, EXIF 方向, 预览图)，未命中时返回 None
+    def get(self, key):
+        with self.lock:
+            row = self.db.execute("SELECT width, height, orientation, data FROM thumbnails WHERE key = ?",
+                                  (key,)).fetchone()
+            if row is None:
+                return None
+            self.db.execute("UPDATE thumbnails SET last_used = ? WHERE key = ?", (time.time(), key))
+            self.db.commit()
+        width, height, orientation, data = row
+        preview = Image.open(io.BytesIO(data))
+        preview.load()
+        return width, height, orientation, preview
+
+    def put(self, key, width, height, orientation, preview):
+        buffer = io.BytesIO()
+        if preview.mode in ('RGB', 'L'):
+            preview.save(buffer, format='JPEG', quality=90)
+        else:
+            preview.save(buffer, format='PNG')
+        data = buffer.getvalue()
+        with self.lock:
+            old = self.db.execute("SELECT size FROM thumbnails WHERE key = ?", (key,)).fetchone()
+            self.db.execute("INSERT OR REPLACE INTO thumbnails VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            (key, width, height, orientation, data, len(data), time.time()))
+            self.total += len(data) - (old[0] if old else 0)
+            if self.total > self.max_bytes:
+                self._evict()
+            self.db.commit()
+
+    # 淘汰最久未使用的条目，直到缓存降到上限的 90%
+    def _evict(self):
+        target = self.max_bytes * 0.9
+        rows = self.db.execute("SELECT key, size FROM thumbnails ORDER BY last_used").fetchall()
+        evicted = []
+        for key, size in rows:
+            if self.total <= target:
+                break
+            evicted.append((key,))
+            self.total -= size
+        self.db.executemany("DELETE FROM thumbnails WHERE key = ?", evicted)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+# 内存中的预览图 LRU 缓存，保存可直接显示的预览图（转换为 PhotoImage 之前）
+# 回滚、跳转回看最近的图片时既不解码也不重新缩放；未命中时再查询磁盘缓存 backing
+class PreviewCache:
+    def __init__(self, max_mb=PREVIEW_CACHE_MB, backing=None):
+        self.max_bytes = max_mb * 1024 * 1024
+        self.backing = backing
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # 键 -> (原图宽, 原图高, EXIF 方向, 预览图)，最久未使用的在前
+        self.used = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                return entry
+        if self.backing is None:
+            return None
+        entry = self.backing.get(key)
+        if entry is not None:
+            self._remember(key, entry)
+        return entry
+
+    def put(self, key, width, height, orientation, preview):
+        self._remember(key, (width, height, orientation, preview))
+        if self.backing is not None:
+            self.backing.put(key, width, height, orientation, preview)
+
+    def _remember(self, key, entry):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.used -= image_nbytes(old[3])
+            self.entries[key] = entry
+            self.used += image_nbytes(entry[3])
+            while self.used > self.max_bytes and len(self.entries) > 1:
+                _, evicted = self.entries.popitem(last=False)
+                self.used -= image_nbytes(evicted[3])
+
+    def close(self):
+        with self.lock:
+            self.entries.clear()
+            self.used = 0
+        if self.backing is not None:
+            self.backing.close()
+
+
+# 打开预览图缓存，无法创建时（如目录只读）不使用缓存
+def open_thumbnail_cache(path=THUMBNAIL_CACHE_PATH, max_mb=THUMBNAIL_CACHE_MB):
+    if max_mb <= 0:
+        return None
+    try:
+        return ThumbnailCache(path, max_mb)
+    except sqlite3.Error:
+        return None
+
+
+# 检查尺寸后解码图片，返回 (图片, EXIF 方向, 原始宽高)；JPEG 使用 draft 模式按接近显示尺寸的比例解码
+def decode_image(image_path, max_image_size):
+    with Image.open(image_path) as img:
+        # Image.open 只解析文件头，先检查尺寸，超限的图片不会被解码
+        check_image_size(img, image_path, max_image_size)
+        orientation = read_orientation(img)
+        size = img.size
+        if DRAFT_PREVIEW and img.format == 'JPEG':
+            img.draft(img.mode, DISPLAY_SIZE)
+        return img.copy(), orientation, size
+
+
+# 把解码后的图片用 LANCZOS 缩小到显示尺寸，并按 EXIF 方向摆正
+def make_preview(img, orientation):
+    img.thumbnail(DISPLAY_SIZE, Image.LANCZOS)
+    return apply_orientation(img, orientation)
+
+
+# 解码图片并生成显示用缩略图（可在后台线程中运行）
+# 返回 (显示图片, EXIF 方向)，显示图片已按 EXIF 方向摆正；完整图片只在保存需要重新编码时才解码
+# JPEG 使用 draft 模式按接近显示尺寸的比例解码；提供 cache（PreviewCache 或 ThumbnailCache）时优先从缓存读取
+def prepare_image(image_path, max_image_size, cache=None):
+    key = None
+    if cache is not None:
+        try:
+            key = ThumbnailCache.make_key(image_path)
+            cached = cache.get(key)
+        except (OSError, sqlite3.Error):
+            cached = None
+        if cached is not None:
+            width, height, orientation, display_img = cached
+            if width > max_image_size[0] or height > max_image_size[1]:
+                raise ImageTooLargeError(f"图像 {os.path.basename(image_path)} 超过最大尺寸限制")
+            return display_img, orientation
+
+    display_img, orientation, (width, height) = decode_image(image_path, max_image_size)
+    display_img = make_preview(display_img, orientation)
+    if key is not None:
+        try:
+            cache.put(key, width, height, orientation, display_img)
+        except (OSError, sqlite3.Error):
+            pass
+    return display_img, orientation
+
+
+# 生成 JPEG 的占位预览，放大到完整预览的尺寸后按方向显示，只用于精细预览完成前的过渡：
+# 优先用内嵌的 EXIF 缩略图（只读文件头），没有时用 draft 按显示尺寸的 1/COARSE_DRAFT_SCALE 粗略解码
+# 超限时与 prepare_image 一样抛出 ImageTooLargeError；其他格式无法廉价地生成占位预览，返回 None
+def prepare_placeholder(image_path, max_image_size):
+    with Image.open(image_path) as img:
+        check_image_size(img, image_path, max_image_size)
+        if img.format != 'JPEG':
+            return None
+        orientation = read_orientation(img)
+        width, height = img.size
+        scale = min(DISPLAY_SIZE[0] / width, DISPLAY_SIZE[1] / height, 1)
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        placeholder = _exif_placeholder(image_path, size) if EXIF_PLACEHOLDER else None
+        if placeholder is None:
+            img.draft(img.mode, (max(1, size[0] // COARSE_DRAFT_SCALE), max(1, size[1] // COARSE_DRAFT_SCALE)))
+            placeholder = img.convert('RGB').resize(size, Image.BILINEAR)
+    return apply_orientation(placeholder, orientation), orientation
+
+
+def _exif_placeholder(image_path, size):
+    data = read_exif_thumbnail(image_path)
+    if data is None:
+        return None
+    try:
+        with Image.open(io.BytesIO(data)) as thumb:
+            return thumb.convert('RGB').resize(size, Image.BILINEAR)
+    except Exception:
+        return None
+
+
+# 后台预读取：提前解码接下来的若干张图片
+class ImagePrefetcher:
+    def __init__(self, base_path, max_image_size, depth=PREFETCH_DEPTH, cache=None):
+        self.base_path = base_path
+        self.max_image_size = max_image_size
+        self.depth = depth
+        self.cache = cache
+        self.executor = ThreadPoolExecutor(max_workers=max(1, depth))
+        self.futures = {}  # 文件名 -> Future，按文件名索引，列表增删不影响结果
+
+    # 按接下来要显示的图片刷新预读取窗口，丢弃已不在窗口中的任务
+    def schedule(self, names):
+        wanted = names[:self.depth]
+        for name in list(self.futures):
+            if name not in wanted:
+                self.futures.pop(name).cancel()
+        for name in wanted:
+            if name not in self.futures:
+                image_path = os.path.join(self.base_path, name)
+                self.futures[name] = self.executor.submit(prepare_image, image_path, self.max_image_size, self.cache)
+
+    # 取出预读取结果；未预读取的图片在当前线程中直接解码
+    def get(self, name):
+        future = self.futures.pop(name, None)
+        if future is None or future.cancelled():
+            return prepare_image(os.path.join(self.base_path, name), self.max_image_size, self.cache)
+        return future.result()
+
+    # 预读取已完成时直接返回结果；正在解码时先稍等片刻；JPEG 随后立即返回占位预览（内嵌缩略图或 1/8 粗略解码），
+    # 同时返回在后台生成精细预览的 Future；其他格式等待后台解码完成
+    def get_fast(self, name):
+        image_path = os.path.join(self.base_path, name)
+        future = self.futures.pop(name, None)
+        if future is not None and future.running():
+            wait((future,), timeout=PREFETCH_WAIT)
+        if future is not None and future.done() and not future.cancelled():
+            return future.result(), None
+        if future is None or future.cancelled():
+            future = self.executor.submit(prepare_image, image_path, self.max_image_size, self.cache)
+        placeholder = prepare_placeholder(image_path, self.max_image_size)
+        if placeholder is None:
+            # 其他格式的粗略预览也要完整解码，不如直接等待后台的精细预览
+            return future.result(), None
+        return placeholder, future
+
+    def discard(self, name):
+        future = self.futures.pop(name, None)
+        if future is not None:
+            future.cancel()
+
+    def shutdown(self):
+        for future in self.futures.values():
+            future.cancel()
+        self.futures.clear()
+        self.executor.shutdown(wait=False)
+
+
+# 移动文件：同一文件系统内为原子重命名；跨文件系统时先复制到临时文件并落盘，再替换为目标文件，最后删除源文件
+# 任何时刻崩溃，目标文件存在时都是完整的
+def move_file(src, dst):
+    try:
+        os.replace(src, dst)
+        return
+    except OSError:
+        pass
+    tmp_path = dst + '.tmp'
+    try:
+        shutil.copy2(src, tmp_path)
+        replace_synced(tmp_path, dst)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.remove(src)
+
+
+# 回滚记录：只保存路径和方向信息，预览图按内存上限保留最近的若干张，较早的转存到临时目录
+class UndoHistory:
+    def __init__(self, memory_mb=UNDO_MEMORY_MB, spill_mb=UNDO_SPILL_MB):
+        self.memory_limit = memory_mb * 1024 * 1024
+        self.spill_limit = spill_mb * 1024 * 1024
+        self.entries = []  # (编号, 原路径, 保存路径, 方向, 撤销时恢复的方向, 分组)，同一分组的记录一起回滚
+        self.previews = OrderedDict()  # 编号 -> 预览图，最早的在前
+        self.memory_used = 0
+        self.spilled = {}  # 编号 -> (文件路径, 模式, 尺寸, 字节数)
+        self.spill_used = 0
+        self.spill_dir = None
+        self.next_id = 0
+        self.next_group = 0
+        self.resolved = 0  # 前 resolved 条记录不再引用后台写入的提交
+
+    def __len__(self):
+        return len(self.entries)
+
+    def push(self, image_path, save_path, orientation, restore_orientation, preview, group=None):
+        entry_id = self.next_id
+        self.next_id += 1
+        if group is not None:
+            self.next_group = max(self.next_group, group + 1)
+        self.entries.append((entry_id, image_path, save_path, orientation, restore_orientation, group))
+        if preview is not None:
+            self.previews[entry_id] = preview
+            self.memory_used += image_nbytes(preview)
+            self._evict()
+
+    # 弹出最近一条记录，返回 (原路径, 保存路径, 方向, 恢复的方向, 预览图或 None, 分组)
+    def pop(self):
+        entry_id, image_path, save_path, orientation, restore_orientation, group = self.entries.pop()
+        self.resolved = min(self.resolved, len(self.entries))
+        preview = self.previews.pop(entry_id, None)
+        if preview is not None:
+            self.memory_used -= image_nbytes(preview)
+        elif entry_id in self.spilled:
+            preview = self._load_spilled(entry_id)
+        return image_path, save_path, orientation, restore_orientation, preview, group
+
+    # 最近一条记录的分组，没有记录时为 None
+    def top_group(self):
+        return self.entries[-1][5] if self.entries else None
+
+    # 新分组的编号，与已有的分组（包括从进度中恢复的）都不相同
+    def new_group(self):
+        group = self.next_group
+        self.next_group += 1
+        return group
+
+    # 把已完成的后台写入换成恢复的方向，写入失败的图片移出回滚记录，记录不再长期引用提交对象
+    # 写入按提交顺序完成，未完成的记录总在末尾，每次从上次停下的位置继续
+    def resolve(self):
+        start = index = min(self.resolved, len(self.entries))
+        kept = []
+        while index < len(self.entries):
+            entry_id, image_path, save_path, orientation, restore_orientation, group = self.entries[index]
+            if isinstance(restore_orientation, CommitJob):
+                if not restore_orientation.finished.is_set():
+                    break
+                if not restore_orientation.committed(image_path):
+                    self._forget(entry_id)
+                    index += 1
+                    continue
+                restore_orientation = restore_orientation.restore_for(image_path)
+            kept.append((entry_id, image_path, save_path, orientation, restore_orientation, group))
+            index += 1
+        self.entries[start:index] = kept
+        self.resolved = start + len(kept)
+
+    def _forget(self, entry_id):
+        preview = self.previews.pop(entry_id, None)
+        if preview is not None:
+            self.memory_used -= image_nbytes(preview)
+        elif entry_id in self.spilled:
+            self._drop_spilled(entry_id)
+
+    # 超出内存上限时把最早的预览图写入临时目录，临时目录满了则丢弃其中最早的预览图
+    def _evict(self):
+        while self.memory_used > self.memory_limit and len(self.previews) > 1:
+            entry_id, preview = self.previews.popitem(last=False)
+            nbytes = image_nbytes(preview)
+            self.memory_used -= nbytes
+            while self.spilled and self.spill_used + nbytes > self.spill_limit:
+                self._drop_spilled(next(iter(self.spilled)))
+            if self.spill_used + nbytes <= self.spill_limit:
+                try:
+                    self._spill(entry_id, preview)
+                except OSError:
+                    pass
+
+    def _drop_spilled(self, entry_id):
+        spill_path, _, _, nbytes = self.spilled.pop(entry_id)
+        self.spill_used -= nbytes
+        try:
+            os.remove(spill_path)
+        except OSError:
+            pass
+
+    def _spill(self, entry_id, preview):
+        if preview.mode not in ('RGB', 'RGBA', 'L'):
+            preview = preview.convert('RGBA')
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.mkdtemp(prefix='classify_pic_undo_')
+        spill_path = os.path.join(self.spill_dir, f"{entry_id}.raw")
+        with open(spill_path, 'wb') as f:
+            f.write(preview.tobytes())
+        nbytes = image_nbytes(preview)
+        self.spilled[entry_id] = (spill_path, preview.mode, preview.size, nbytes)
+        self.spill_used += nbytes
+
+    def _load_spilled(self, entry_id):
+        spill_path, mode, size, nbytes = self.spilled.pop(entry_id)
+        self.spill_used -= nbytes
+        try:
+            with open(spill_path, 'rb') as f:
+                preview = Image.frombytes(mode, size, f.read())
+            os.remove(spill_path)
+        except OSError:
+            return None
+        return preview
+
+    # 导出回滚记录（不含预览图），用于保存会话进度；调用前需暂停后台写入，失败的提交不导出
+    # 返回 (回滚记录, 尚未开始写入的原路径)，分组重新编号为从 0 开始的整数
+    def snapshot(self):
+        records = []
+        unwritten = []
+        groups = {}
+        for _, image_path, save_path, orientation, restore_orientation, group in self.entries:
+            if isinstance(restore_orientation, CommitJob):
+                if restore_orientation.state == 'pending':
+                    unwritten.append(image_path)
+                    continue
+                if not restore_orientation.committed(image_path):
+                    continue
+                restore_orientation = restore_orientation.restore_for(image_path)
+            if group is not None:
+                group = groups.setdefault(group, len(groups))
+            records.append([image_path, save_path, orientation, restore_orientation, group])
+        return records, unwritten
+
+    def clear(self):
+        self.entries.clear()
+        self.previews.clear()
+        self.spilled.clear()
+        self.memory_used = self.spill_used = 0
+        self.resolved = 0
+        if self.spill_dir is not None:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+            self.spill_dir = None
+
+
+# 预写日志：每次移动/保存/移入错误文件夹/回滚前先记录意图，完成后再记录结果
+# 程序崩溃或断电后，下次启动时根据日志和文件实际状态补完或回滚未完成的操作
+class OperationJournal:
+    def __init__(self, target_base_path, name=JOURNAL_NAME):
+        self.path = os.path.join(target_base_path, name)
+        self.file = None
+        self.lock = threading.RLock()  # 批量分类时多个线程同时写日志
+        self.next_seq = 0
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def _read_records(self):
+        records = []
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # 最后一行可能只写了一半
+                    break
+        return records
+
+    # 处理上次未正常结束的日志，返回 (补完或回滚的操作数, 按顺序排列的已完成操作记录)
+    def recover(self):
+        if not os.path.exists(self.path):
+            return 0, []
+        begins = OrderedDict()
+        results = {}
+        for record in self._read_records():
+            if record.get('state') == 'begin':
+                begins[record['seq']] = record
+            elif record.get('state') == 'done':
+                results[record['seq']] = record
+        repaired = 0
+        completed = []
+        for seq, record in begins.items():
+            if seq in results:
+                record['restore'] = results[seq].get('restore')
+            else:
+                repaired += 1
+                if not self._finish(record):
+                    continue
+            completed.append(record)
+        self.next_seq = max(begins, default=-1) + 1
+        self._compact(completed)
+        return repaired, completed
+
+    # 根据文件实际状态补完（返回 True）或回滚（返回 False）一条未完成的操作
+    @staticmethod
+    def _finish(record):
+        if record['op'] in ('bulk', 'bulk_undo'):
+            return OperationJournal._finish_bulk(record)
+        src, dst = record['src'], record['dst']
+        src_exists, dst_exists = os.path.exists(src), os.path.exists(dst)
+        if dst_exists and not (src_exists and record.get('dst_existed')):
+            # 目标文件通过原子替换写入，存在即完整，删除残留的源文件
+            if src_exists:
+                os.remove(src)
+            if record['op'] == 'classify':
+                record['restore'] = OperationJournal._committed_restore(record)
+            return True
+        if os.path.exists(dst + '.tmp'):
+            # 跨文件系统复制到一半的临时文件
+            os.remove(dst + '.tmp')
+        if src_exists and record.get('src_orientation') is not None and is_jpeg_file(src):
+            # 源文件的方向标签可能已被原地改写，恢复原值
+            with Image.open(src) as img:
+                current = read_orientation(img)
+            if current != record['src_orientation']:
+                write_jpeg_orientation(src, src, record['src_orientation'])
+        return False
+
+    # 整组操作只完成了一部分时，每张图片按单个操作的规则补完或回滚
+    # restore 中记录已完成的图片 [(在 items 中的位置, 恢复的方向), ...]
+    @staticmethod
+    def _finish_bulk(record):
+        op = 'classify' if record['op'] == 'bulk' else 'undo'
+        completed = []
+        for index, item in enumerate(record['items']):
+            item = dict(item, op=op)
+            if OperationJournal._finish(item):
+                completed.append([index, item.get('restore')])
+        record['restore'] = completed
+        return True
+
+    # 推断已完成的分类是改写了方向标签（返回原方向）还是重新编码了像素（返回 None）
+    @staticmethod
+    def _committed_restore(record):
+        base, orientation = record.get('src_orientation'), record.get('orientation')
+        if orientation == base:
+            return base
+        if is_jpeg_file(record['dst']):
+            with Image.open(record['dst']) as img:
+                if read_orientation(img) == orientation:
+                    return base
+        return None
+
+    # 只保留已完成的操作，重写日志
+    def _compact(self, completed):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for record in completed:
+                begin = dict(record, state='begin')
+                begin.pop('restore', None)
+                f.write(json.dumps(begin, ensure_ascii=False) + '\n')
+                f.write(json.dumps({'seq': record['seq'], 'state': 'done', 'restore': record.get('restore')},
+                                   ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def _append(self, record):
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.path, 'a', encoding='utf-8')
+            self.file.write(line)
+            # flush 保证进程崩溃后日志仍在，fsync 按批次执行以减少断电保护的开销
+            self.file.flush()
+            self.unsynced += 1
+            if self.unsynced >= JOURNAL_SYNC_EVERY or time.monotonic() - self.last_sync >= JOURNAL_SYNC_INTERVAL:
+                self.sync()
+
+    def sync(self):
+        with self.lock:
+            if self.file is not None and self.unsynced:
+                os.fsync(self.file.fileno())
+            self.unsynced = 0
+            self.last_sync = time.monotonic()
+
+    # 记录操作意图，返回序号；src_orientation 为操作前源文件的方向标签（会改写标签时才需要）
+    def begin(self, op, src, dst, src_orientation=None, **extra):
+        dst_existed = os.path.exists(dst)
+        with self.lock:
+            seq = self.next_seq
+            self.next_seq += 1
+            self._append(dict(extra, seq=seq, state='begin', op=op, src=src, dst=dst,
+                              dst_existed=dst_existed, src_orientation=src_orientation))
+        return seq
+
+    # 一条记录中包含一组操作，items 为 [(原路径, 目标路径, 源文件的方向标签, 目标方向), ...]
+    def begin_group(self, op, items):
+        items = [{'src': src, 'dst': dst, 'dst_existed': os.path.exists(dst), 'src_orientation': src_orientation,
+                  'orientation': orientation} for src, dst, src_orientation, orientation in items]
+        with self.lock:
+            seq = self.next_seq
+            self.next_seq += 1
+            self._append({'seq': seq, 'state': 'begin', 'op': op, 'items': items})
+        return seq
+
+    def done(self, seq, restore=None):
+        self._append({'seq': seq, 'state': 'done', 'restore': restore})
+
+    # 会话进度保存后清空日志，序号继续递增
+    def reset(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        with open(self.path, 'w', encoding='utf-8') as f:
+            f.flush()
+            os.fsync(f.fileno())
+        self.unsynced = 0
+
+    # 正常结束时删除日志
+    def close(self, clean=True):
+        if self.file is not None:
+            self.sync()
+            self.file.close()
+            self.file = None
+        if clean and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def same_path(a, b):
+    return os.path.normcase(os.path.abspath(a)) == os.path.normcase(os.path.abspath(b))
+
+
+# 返回 path 相对 base_path 的路径，不在 base_path 之下时返回 None
+def relative_name(path, base_path):
+    try:
+        name = os.path.relpath(path, base_path)
+    except ValueError:
+        return None
+    return None if name == os.pardir or name.startswith(os.pardir + os.sep) else name
+
+
+# 把日志中的已完成操作应用到回滚记录和待分类队列上
+# queue 为 None 时只更新回滚记录（队列由重新扫描得到），否则返回更新后的队列
+# 回滚记录为 (原路径, 保存路径, 方向, 恢复的方向, 分组)，整组分类的记录分组编号接着已有的编号
+def replay_journal(records, base_path, history_records, queue=None):
+    removed = set()
+    restored = []
+    next_group = max((record[4] for record in history_records if record[4] is not None), default=-1) + 1
+    for record in records:
+        if record['op'] == 'bulk':
+            for index, restore in record.get('restore') or ():
+                item = record['items'][index]
+                name = relative_name(item['src'], base_path)
+                if name is not None:
+                    removed.add(name)
+                    history_records.append((item['src'], item['dst'], item['orientation'], restore, next_group))
+            next_group += 1
+            continue
+        if record['op'] == 'bulk_undo':
+            # 整组回滚时弹出整组记录，回滚失败的图片仍留在回滚记录中
+            reverted = {index for index, _ in record.get('restore') or ()}
+            group = history_records[len(history_records) - len(record['items']):]
+            del history_records[len(history_records) - len(group):]
+            for index, item in enumerate(record['items']):
+                if index in reverted:
+                    name = relative_name(item['dst'], base_path)
+                    if name is not None:
+                        removed.discard(name)
+                        restored.append(name)
+                elif index < len(group):
+                    history_records.append(group[index])
+            continue
+        image_path = record['dst'] if record['op'] == 'undo' else record['src']
+        name = relative_name(image_path, base_path)
+        if name is None:
+            continue
+        if record['op'] == 'undo':
+            removed.discard(name)
+            restored.append(name)
+            if history_records:
+                history_records.pop()
+        else:
+            removed.add(name)
+            if record['op'] == 'classify':
+                history_records.append((record['src'], record['dst'],
+                                        record.get('orientation', record.get('src_orientation')),
+                                        record.get('restore'), None))
+    if queue is None:
+        return None
+    # 回滚的图片排在队首，最后回滚的最先显示
+    front = []
+    for name in reversed(restored):
+        if name not in removed and name not in front:
+            front.append(name)
+    front_names = set(front)
+    return front + [name for name in queue if name not in removed and name not in front_names]
+
+
+# 会话进度：保存剩余队列、回滚记录和分类类别，重新打开时无需重新扫描目录
+class SessionState:
+    def __init__(self, target_base_path):
+        self.path = os.path.join(target_base_path, SESSION_NAME)
+
+    @staticmethod
+    def directory_mtime(base_path):
+        return os.stat(base_path).st_mtime_ns
+
+    # 读取与 base_path 和扫描方式对应的进度，不存在或不匹配时返回 None
+    def load(self, base_path, recursive=False):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not same_path(state.get('base_path', ''), base_path) or state.get('recursive', False) != recursive:
+            return None
+        return state
+
+    # complete 为 False 表示保存时目录尚未扫描完，下次打开只恢复回滚记录并重新扫描
+    def save(self, base_path, queue, history_records, targets, journal_seq, complete=True, recursive=False):
+        state = {
+            'base_path': os.path.abspath(base_path),
+            'recursive': recursive,
+            'complete': complete,
+            'base_mtime': self.directory_mtime(base_path),
+            'journal_seq': journal_seq,
+            'targets': targets,
+            'queue': queue,
+            'history': history_records,
+        }
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f, ensure_ascii=False, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+# 把无法处理的图片移入错误文件夹（保留子文件夹结构），并记录到操作日志
+def move_to_error_folder(journal, base_path, image_name, error_folder):
+    image_path = os.path.join(base_path, image_name)
+    error_path = os.path.join(error_folder, image_name)
+    os.makedirs(os.path.dirname(error_path), exist_ok=True)
+    seq = journal.begin('error', image_path, error_path)
+    move_file(image_path, error_path)
+    journal.done(seq)
+
+
+# 在错误文件夹的日志中记录一张坏图片及原因
+def append_error_log(error_folder, image_name, reason):
+    with open(os.path.join(error_folder, ERROR_LOG_NAME), 'a', encoding='utf-8') as f:
+        f.write(f"{time.strftime('%Y-%m-%d %H:%M:%S')}\t{image_name}\t{reason}\n")
+
+
+# 一次分类提交：移动/写入方向/重新编码，在后台写入线程中执行
+class CommitJob:
+    def __init__(self, image_path, save_path, base_orientation, orientation):
+        self.image_path = image_path
+        self.save_path = save_path
+        self.base_orientation = base_orientation
+        self.orientation = orientation
+        self.state = 'pending'  # pending / running / done / failed / cancelled
+        self.restore = None  # 完成后为 commit_image 的返回值
+        self.error = None
+        self.finished = threading.Event()
+
+    def run(self, journal):
+        os.makedirs(os.path.dirname(self.save_path), exist_ok=True)
+        seq = journal.begin('classify', self.image_path, self.save_path, src_orientation=self.base_orientation,
+                            orientation=self.orientation)
+        self.restore = commit_image(self.image_path, self.save_path, self.base_orientation, self.orientation)
+        journal.done(seq, self.restore)
+
+    # image_path 是否已写入目标位置
+    def committed(self, image_path):
+        return self.state == 'done'
+
+    def restore_for(self, image_path):
+        return self.restore
+
+    # 需要放回队列的图片 [(原路径, 异常), ...]
+    def failed_images(self):
+        return [(self.image_path, self.error)] if self.state == 'failed' else []
+
+
+# 把当前图片连同它的重复图片一起分类，整组只记一条 bulk 日志
+# commits 为 [(原路径, 保存路径, 原方向, 目标方向), ...]，当前图片在最后；重复图片的两个方向相同，原样移动
+class BulkMoveJob(CommitJob):
+    def __init__(self, commits):
+        super().__init__(*commits[-1])
+        self.commits = commits
+        self.restores = {}  # 已写入的原路径 -> 恢复的方向
+        self.errors = []  # 写入失败的 (原路径, 异常)
+
+    def run(self, journal):
+        committed, self.errors = commit_group(journal, self.commits)
+        self.restores = {image_path: restore for image_path, _, _, restore in committed}
+        self.restore = self.restores.get(self.image_path)
+
+    def committed(self, image_path):
+        return self.state == 'done' and image_path in self.restores
+
+    def restore_for(self, image_path):
+        return self.restores[image_path]
+
+    def failed_images(self):
+        if self.state == 'failed':
+            return [(image_path, self.error) for image_path, _, _, _ in self.commits]
+        return self.errors
+
+
+# 在一条日志记录中提交一组图片，commits 为 [(原路径, 保存路径, 原方向, 目标方向), ...]
+# 返回 (已提交的 [(原路径, 保存路径, 方向, 恢复的方向), ...], 失败的 [(原路径, 异常), ...])
+def commit_group(journal, commits):
+    for _, save_path, _, _ in commits:
+        os.makedirs(os.path.dirname(save_path), exist_ok=True)
+    seq = journal.begin_group('bulk', commits)
+    committed = []
+    errors = []
+    for index, (image_path, save_path, base_orientation, orientation) in enumerate(commits):
+        try:
+            restore = commit_image(image_path, save_path, base_orientation, orientation)
+        except Exception as e:
+            errors.append((image_path, e))
+            continue
+        committed.append((index, image_path, save_path, orientation, restore))
+    journal.done(seq, [[index, restore] for index, _, _, _, restore in committed])
+    return [entry[1:] for entry in committed], errors
+
+
+# 在一条日志记录中回滚一组提交，entries 为回滚记录 [(原路径, 保存路径, 方向, 恢复的方向), ...]
+# 返回 (已回滚的记录, 失败的 [(记录, 异常), ...])
+def revert_group(journal, entries):
+    seq = journal.begin_group('bulk_undo', [
+        (save_path, image_path, None if restore is None else orientation, restore)
+        for image_path, save_path, orientation, restore in entries])
+    reverted = []
+    errors = []
+    for index, entry in enumerate(entries):
+        image_path, save_path, orientation, restore = entry
+        try:
+            revert_commit(image_path, save_path, restore, orientation)
+        except Exception as e:
+            errors.append((entry, e))
+            continue
+        reverted.append((index, entry))
+    journal.done(seq, [[index, None] for index, _ in reverted])
+    return [entry for _, entry in reverted], errors
+
+
+# 后台写入：分类提交按顺序交给单个线程执行，界面不用等待磁盘（网络盘上尤其明显）
+# 队列有上限，写入跟不上时 submit 会阻塞，避免积压过多尚未落盘的图片；失败的提交放入 failures 由界面取走
+class CommitWriter:
+    def __init__(self, journal, latency, max_pending=COMMIT_QUEUE_SIZE):
+        self.journal = journal
+        self.latency = latency
+        self.jobs = Queue(maxsize=max_pending)
+        self.failures = Queue()
+        self.lock = threading.Lock()
+        self.running = None  # 正在写入的提交
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                if job is None:
+                    return
+                with self.lock:
+                    if job.state != 'pending':
+                        continue
+                    job.state = 'running'
+                    self.running = job
+                try:
+                    with self.latency.measure('write'):
+                        job.run(self.journal)
+                    job.state = 'done'
+                    if job.failed_images():
+                        self.failures.put(job)
+                except Exception as e:
+                    job.error = e
+                    job.state = 'failed'
+                    self.failures.put(job)
+                job.finished.set()
+                self.running = None
+            finally:
+                self.jobs.task_done()
+
+    def submit(self, job):
+        self.jobs.put(job)
+
+    # 尚未开始写入的提交直接取消，文件保持原样；已开始的返回 False，调用方需等待其完成
+    def cancel(self, job):
+        with self.lock:
+            if job.state == 'pending':
+                job.state = 'cancelled'
+                job.finished.set()
+                return True
+        return False
+
+    def failed(self):
+        jobs = []
+        while True:
+            try:
+                jobs.append(self.failures.get_nowait())
+            except Empty:
+                return jobs
+
+    # 等待已提交的写入全部完成
+    def flush(self):
+        self.jobs.join()
+
+    # 暂停写入：只等待正在写入的一张完成，排队中的提交在退出前不会开始，也不会写日志
+    @contextmanager
+    def paused(self):
+        with self.lock:
+            running = self.running
+            if running is not None:
+                running.finished.wait()
+            yield
+
+    def close(self):
+        self.jobs.put(None)
+        self.thread.join()
+
+
+# 分类引擎：待分类队列、预读取、分类提交、旋转/翻转、回滚和会话进度，不依赖任何界面
+# 图形界面只负责显示 current_display 并把按键转换为对引擎的调用
+class ClassifierEngine:
+    def __init__(self, base_path, target_base_path, targets=None, max_image_size=MAX_IMAGE_SIZE,
+                 prefetch_depth=PREFETCH_DEPTH, undo_memory_mb=UNDO_MEMORY_MB, preview_cache_mb=PREVIEW_CACHE_MB,
+                 resume=True, recursive=False, background_scan=True, trace=False):
+        self.base_path = base_path
+        self.target_base_path = target_base_path
+        self.max_image_size = max_image_size
+        self.prefetch_depth = prefetch_depth
+        self.latency = LatencyTracker(trace)
+
+        # 先处理上次异常退出时未完成的操作
+        self.journal = OperationJournal(target_base_path)
+        self.repaired, completed = self.journal.recover()
+
+        # 有可用的会话进度时直接恢复队列，只有目录在进度保存后被外部修改过才重新扫描
+        self.session = SessionState(target_base_path)
+        self.recursive = recursive
+        state = self.session.load(base_path, recursive) if resume else None
+        # 早期版本保存的回滚记录没有分组
+        history_records = [tuple(record) + (None,) * (5 - len(record)) for record in state['history']] if state else []
+        pending = [record for record in completed if not state or record['seq'] >= state['journal_seq']]
+        if state:
+            # 上次正常退出时日志已删除，序号要接着进度中的序号继续，否则崩溃后新记录会被当作已保存而忽略
+            self.journal.next_seq = max(self.journal.next_seq, state['journal_seq'])
+        self.scanner = None
+        if state and state.get('complete', True):
+            image_names = replay_journal(pending, base_path, history_records, state['queue'])
+            # 目录在进度保存后被修改过时重新扫描，只补上队列中没有的图片；已不存在的图片在显示时跳过
+            # 崩溃前未保存的操作也会改变目录时间，与外部新增的文件无法区分，这时同样重新扫描
+            # 包含子文件夹时顶层目录的时间反映不了子文件夹中的变化，总是在后台重新扫描
+            rescan = recursive or state['base_mtime'] != SessionState.directory_mtime(base_path)
+        else:
+            replay_journal(pending, base_path, history_records)
+            image_names = []
+            rescan = True
+        if rescan:
+            # 目标路径位于待筛选路径之下时不扫描目标路径
+            if background_scan:
+                self.scanner = ImageScanner(base_path, recursive, exclude=(target_base_path,))
+            else:
+                known = set(image_names)
+                image_names += [name for name in scan_images(base_path, recursive, exclude=(target_base_path,))
+                                if name not in known]
+        self.targets = targets or (state and state.get('targets')) or DEFAULT_TARGETS
+        self.images = WorkQueue(image_names)
+
+        self.error_folder = os.path.join(target_base_path, 'error')
+        os.makedirs(self.error_folder, exist_ok=True)
+        self.error_count = 0
+
+        self.history = UndoHistory(undo_memory_mb)
+        # 恢复之前会话中的分类记录，使其仍可回滚
+        for image_path, save_path, last_orientation, restore_orientation, group in history_records:
+            self.history.push(image_path, save_path, last_orientation, restore_orientation, None, group)
+        self.saved_seq = self.journal.next_seq
+
+        self.display = None  # 预览图，方向为 display_orientation；取 current_display 时才套用之后的旋转/翻转
+        self.display_orientation = 1
+        self.generation = 0  # 每换一张图片加一，界面据此丢弃过期的精细预览
+        self.refining = None  # 当前图片的精细预览任务，显示的是粗略预览时才有
+        self.base_orientation = 1  # 文件当前的 EXIF 方向
+        self.orientation = 1  # 用户旋转/翻转后的目标方向，与 base_orientation 相同时直接移动文件
+        self.preview_cache = PreviewCache(preview_cache_mb, open_thumbnail_cache())
+        self.prefetcher = ImagePrefetcher(base_path, max_image_size, prefetch_depth, self.preview_cache)
+        self.prefetcher.schedule(self.images.peek(prefetch_depth))
+        self.writer = CommitWriter(self.journal, self.latency)
+        self.duplicates = None
+        if DUPLICATE_GROUPING and np is not None:
+            self.duplicates = DuplicateIndex(base_path, max_image_size)
+            self.duplicates.add(self.images.pending())
+
+    @property
+    def scanning(self):
+        return self.scanner is not None
+
+    # 读取后台扫描到的图片；有新图片或扫描结束时返回 True
+    def poll(self):
+        if self.scanner is None:
+            return False
+        finished = self.scanner.finished
+        names = self.scanner.drain()
+        self.enqueue(names)
+        if finished:
+            self.scanner = None
+        return bool(names) or finished
+
+    def enqueue(self, names):
+        waiting = not self.images
+        # 恢复进度后重新扫描时，已在队列中的图片不再加入
+        names = [name for name in names if name not in self.images]
+        self.images.extend(names)
+        if self.duplicates is not None:
+            self.duplicates.add(names)
+        self.prefetcher.schedule(self.images.peek(self.prefetch_depth, skip=0 if waiting else 1))
+
+    def current(self):
+        return self.images.current()
+
+    # 准备当前图片的预览，循环跳过无法显示的图片；队列为空时返回 False
+    def load(self):
+        while self.images:
+            image_name = self.images.current()
+            image_path = os.path.join(self.base_path, image_name)
+            if not os.path.exists(image_path):
+                # 队列来自保存的进度时，文件可能已被外部移走
+                self.prefetcher.discard(image_name)
+                self.images.pop_current()
+                continue
+            self.generation += 1
+            self.refining = None
+            try:
+                with self.latency.measure('load'):
+                    if TIERED_PREVIEW:
+                        (display, base_orientation), self.refining = self.prefetcher.get_fast(image_name)
+                    else:
+                        display, base_orientation = self.prefetcher.get(image_name)
+            except ImageTooLargeError as e:
+                self.skip_broken(image_name, str(e))
+                continue
+            except Exception as e:
+                self.skip_broken(image_name, f"无法打开图像：{e}")
+                continue
+            self.base_orientation = self.orientation = self.display_orientation = base_orientation
+            self.display = display
+            if self.duplicates is not None:
+                # 操作员查看图片时后台就开始查找它的重复图片
+                self.duplicates.watch(image_name)
+            # 当前图片准备好后，立即在后台准备接下来的图片
+            self.prefetcher.schedule(self.images.peek(self.prefetch_depth, skip=1))
+            return True
+        self.display = None
+        return False
+
+    # 把坏图片移入错误文件夹并记录到日志
+    def skip_broken(self, image_name, reason):
+        try:
+            move_to_error_folder(self.journal, self.base_path, image_name, self.error_folder)
+        except OSError as e:
+            reason += f"（移动失败：{e}）"
+        self.images.pop_current()
+        # 预读取窗口跟着前移，连续的坏文件也能被并行读取
+        self.prefetcher.schedule(self.images.peek(self.prefetch_depth))
+        self.error_count += 1
+        append_error_log(self.error_folder, image_name, reason)
+
+    # 把当前图片分类到第 idx 个类别（从 1 开始），文件在后台写入，然后准备下一张
+    def classify(self, idx):
+        if not 1 <= idx <= len(self.targets):
+            raise ValueError(f"请输入1-{len(self.targets)}范围内的数字")
+        image_name = self.images.current()
+        image_path = os.path.join(self.base_path, image_name)
+        save_path = os.path.join(self.target_base_path, self.targets[idx - 1], image_name)
+        job = CommitJob(image_path, save_path, self.base_orientation, self.orientation)
+        with self.latency.measure('commit'):
+            self.writer.submit(job)
+        # 完成前回滚记录中保存的是提交本身，回滚时再取恢复的方向
+        self.history.push(image_path, save_path, self.orientation, job, self.current_display)
+        self.images.pop_current()
+        self.latency.mark_classified()
+        return self.load()
+
+    # 队列中与当前图片重复的其他图片（哈希和查询都在后台进行，刚显示时可能还没有结果）
+    def find_duplicates(self):
+        image_name = self.images.current()
+        if self.duplicates is None or image_name is None:
+            return []
+        self.duplicates.watch(image_name)
+        return [name for name in self.duplicates.find(image_name) if name in self.images]
+
+    # 把当前图片和它的全部重复图片分类到第 idx 个类别，整组在后台一次写入、一次回滚
+    # 返回 (是否还有图片, 一起分类的重复图片数)
+    def classify_duplicates(self, idx):
+        if not 1 <= idx <= len(self.targets):
+            raise ValueError(f"请输入1-{len(self.targets)}范围内的数字")
+        names = self.find_duplicates()
+        if not names:
+            return self.classify(idx), 0
+        target_folder = os.path.join(self.target_base_path, self.targets[idx - 1])
+        image_name = self.images.current()
+        commits = []
+        for name in names:
+            orientation = self.duplicates.orientation(name)
+            commits.append((os.path.join(self.base_path, name), os.path.join(target_folder, name),
+                            orientation, orientation))
+        commits.append((os.path.join(self.base_path, image_name), os.path.join(target_folder, image_name),
+                        self.base_orientation, self.orientation))
+        job = BulkMoveJob(commits)
+        with self.latency.measure('commit'):
+            self.writer.submit(job)
+        # 重复图片先入栈，当前图片在栈顶，回滚时整组一起弹出
+        group = self.history.new_group()
+        for image_path, save_path, _, orientation in commits[:-1]:
+            self.history.push(image_path, save_path, orientation, job, None, group)
+        self.history.push(job.image_path, job.save_path, self.orientation, job, self.current_display, group)
+        for name in names:
+            self.images.remove(name, done=True)
+            self.prefetcher.discard(name)
+        self.images.pop_current()
+        self.latency.mark_classified()
+        return self.load(), len(names)
+
+    # 旋转/翻转只记录组合后的方向，预览图在显示时一次性转到该方向，完整图片在保存时一次性处理
+    # 连续按键只改变方向，中间状态不会被逐个绘制
+    def transform(self, operation):
+        if self.display is None:
+            return False
+        self.orientation = compose_orientation(self.orientation, operation)
+        return True
+
+    @property
+    def current_display(self):
+        if self.display is not None and self.display_orientation != self.orientation:
+            with self.latency.measure('transform'):
+                self.display = apply_orientation(self.display,
+                                                 relative_orientation(self.display_orientation, self.orientation))
+            self.display_orientation = self.orientation
+        return self.display
+
+    # 回滚上一次分类，图片放回队首成为当前图片；没有可回滚的记录时返回 False
+    # 与重复图片一起分类的整组一起回滚，组中的当前图片重新成为当前图片
+    def undo(self):
+        while self.history:
+            last_image_path, last_save_path, last_orientation, restore_orientation, last_display, group = \
+                self.history.pop()
+            members = [(last_image_path, last_save_path, last_orientation, restore_orientation, last_display)]
+            while group is not None and self.history.top_group() == group:
+                members.append(self.history.pop()[:5])
+            members.reverse()
+            if not isinstance(restore_orientation, CommitJob):
+                break
+            job = restore_orientation
+            if self.writer.cancel(job):
+                # 还没有写入，文件仍在原处，保持原来的方向
+                for member in members:
+                    self.images.push_front(relative_name(member[0], self.base_path))
+                self.base_orientation, self.orientation = job.base_orientation, last_orientation
+                self._restore_display(last_image_path, last_display)
+                return True
+            job.finished.wait()
+            # 写入失败的图片已放回队尾并报告给界面，只回滚写入成功的；整个提交都失败时回滚更早的一次
+            members = [(image_path, save_path, orientation, job.restore_for(image_path), display)
+                       for image_path, save_path, orientation, _, display in members if job.committed(image_path)]
+            if members:
+                break
+        else:
+            return False
+        if group is None:
+            self._undo_single(*members[0])
+        else:
+            members = self._undo_group(members, group)
+        last_image_path, _, last_orientation, restore_orientation, last_display = members[-1]
+        if restore_orientation is None:
+            # 像素已按方向重新编码，文件本身即为目标方向
+            self.base_orientation = self.orientation = 1
+        else:
+            self.base_orientation, self.orientation = restore_orientation, last_orientation
+        self._restore_display(last_image_path, last_display)
+        return True
+
+    def _undo_single(self, image_path, save_path, orientation, restore_orientation, display):
+        try:
+            with self.latency.measure('undo'):
+                seq = self.journal.begin('undo', save_path, image_path,
+                                         src_orientation=None if restore_orientation is None else orientation)
+                revert_commit(image_path, save_path, restore_orientation, orientation)
+                self.journal.done(seq)
+        except Exception:
+            self.history.push(image_path, save_path, orientation, restore_orientation, display)
+            raise
+        self.images.push_front(relative_name(image_path, self.base_path))
+
+    # 在一条日志中回滚整组图片并按原顺序放回队首；回滚失败的图片留在回滚记录中，下次回滚时重试
+    # 返回已回滚的记录，全部失败时抛出异常
+    def _undo_group(self, members, group):
+        displays = {image_path: display for image_path, _, _, _, display in members}
+        with self.latency.measure('undo'):
+            reverted, errors = revert_group(self.journal, [member[:4] for member in members])
+        for (image_path, save_path, orientation, restore_orientation), _ in errors:
+            self.history.push(image_path, save_path, orientation, restore_orientation, displays[image_path], group)
+        if not reverted:
+            raise errors[0][1]
+        for image_path, _, _, _ in reverted:
+            self.images.push_front(relative_name(image_path, self.base_path))
+        return [entry + (displays[entry[0]],) for entry in reverted]
+
+    def _restore_display(self, image_path, display):
+        self.generation += 1
+        self.refining = None
+        if display is None:
+            # 预览图已被淘汰，按方向信息从文件重新生成
+            display, file_orientation = prepare_image(image_path, self.max_image_size, self.preview_cache)
+            display = apply_orientation(display, relative_orientation(file_orientation, self.orientation))
+        self.display, self.display_orientation = display, self.orientation
+        self.prefetcher.schedule(self.images.peek(self.prefetch_depth, skip=1))
+
+    # 用后台生成的精细预览替换粗略预览，并套用之后的旋转/翻转
+    # 返回 True 表示当前显示已改变，False 表示尚未完成，None 表示图片已切换或无需替换
+    def refine(self, generation):
+        if generation != self.generation or self.refining is None:
+            return None
+        if not self.refining.done():
+            return False
+        future, self.refining = self.refining, None
+        try:
+            display, file_orientation = future.result()
+        except Exception as e:
+            # 占位预览来自内嵌缩略图时，完整文件可能已损坏，按坏图片处理并准备下一张
+            self.skip_broken(self.images.current(), f"无法打开图像：{e}")
+            self.load()
+            return True
+        # 之后的旋转/翻转在取 current_display 时套用
+        self.display, self.display_orientation = display, file_orientation
+        return True
+
+    # 取出后台写入失败的提交，图片放回队尾；返回 [(文件名, 异常), ...] 供界面提示
+    # 同时把回滚记录中已完成的提交换成恢复的方向
+    def poll_commits(self):
+        self.history.resolve()
+        failed = []
+        for job in self.writer.failed():
+            for image_path, error in job.failed_images():
+                image_name = relative_name(image_path, self.base_path)
+                if os.path.exists(image_path) and image_name not in self.images:
+                    self.images.requeue(image_name)
+                failed.append((image_name, error))
+        return failed
+
+    # 按扫描顺序跳转到第 position 张图片（从 0 开始）
+    def jump(self, position):
+        self.images.jump(position)
+        self.prefetcher.schedule(self.images.peek(self.prefetch_depth))
+        return self.load()
+
+    def stats(self):
+        return {
+            'done': self.images.done,
+            'remaining': len(self.images),
+            'total': self.images.done + len(self.images),
+            'scanned': len(self.images.items),
+            'errors': self.error_count,
+            'undoable': len(self.history),
+            'scanning': self.scanning,
+            'images_per_minute': self.latency.images_per_minute(),
+            'hashed': len(self.duplicates.hashes) if self.duplicates is not None else None,
+            'latency': self.latency.summary(),
+        }
+
+    # 校验队列中的全部图片，返回 [(文件名, 原因), ...]
+    def prescan(self, verify=False):
+        return prescan_images(self.base_path, self.images.pending(), self.max_image_size, verify)
+
+    # 把预扫描发现的问题图片移入错误文件夹并移出队列
+    def reject(self, rejected):
+        for name, reason in rejected:
+            move_to_error_folder(self.journal, self.base_path, name, self.error_folder)
+            append_error_log(self.error_folder, name, reason)
+            self.images.remove(name)
+
+    @property
+    def dirty(self):
+        return self.journal.next_seq != self.saved_seq
+
+    # 保存会话进度，进度中已包含的日志随即清空
+    # 只等待正在写入的一张，排队中的图片按未分类保存在队首；它们的日志序号在进度之后，崩溃后照常重放
+    def save_session(self):
+        self.history.resolve()
+        with self.writer.paused():
+            history_records, unwritten = self.history.snapshot()
+            queue = [relative_name(image_path, self.base_path) for image_path in unwritten] + self.images.pending()
+            self.session.save(self.base_path, queue, history_records, self.targets, self.journal.next_seq,
+                              complete=self.scanner is None, recursive=self.recursive)
+            self.journal.reset()
+        self.saved_seq = self.journal.next_seq
+
+    # save 为 False 时不保存进度（例如预扫描后取消分类）；开启跟踪时在目标路径下导出跟踪文件
+    def close(self, save=True):
+        # 先写完已提交的分类，写入失败的图片回到队列中随进度保存
+        self.writer.close()
+        self.poll_commits()
+        if self.duplicates is not None:
+            self.duplicates.close()
+        if self.latency.trace is not None:
+            try:
+                self.latency.export(os.path.join(self.target_base_path, TRACE_NAME))
+            except OSError:
+                pass
+        self.prefetcher.shutdown()
+        self.preview_cache.close()
+        if self.scanner is not None:
+            self.scanner.stop()
+        if save:
+            if self.images or self.scanner is not None:
+                self.save_session()
+            else:
+                self.session.clear()
+        self.history.clear()
+        self.journal.close()
+
+
+_HASH_SIZE = 8  # dHash 的边长，打包后按 64 位整数读取，不能修改
+
+
+# 计算一组图片的感知哈希（dHash，64 位），在子进程中运行；无法读取或超过尺寸限制的图片结果为 None
+# 每张图片只缩小为 9x8 的灰度图，比较相邻像素和打包成整数在 NumPy 中对整组一次完成
+def hash_images(image_paths, max_image_size):
+    results = [None] * len(image_paths)
+    grids = []
+    indexes = []
+    for i, image_path in enumerate(image_paths):
+        try:
+            with Image.open(image_path) as img:
+                # 与显示时一样先检查尺寸，超限的图片不解码，也不会被整组分类
+                check_image_size(img, image_path, max_image_size)
+                orientation = read_orientation(img)
+                if img.format == 'JPEG':
+                    img.draft('L', (_HASH_SIZE * 8, _HASH_SIZE * 8))
+                gray = img.convert('L').resize((_HASH_SIZE + 1, _HASH_SIZE), Image.BILINEAR, reducing_gap=2.0)
+            grids.append(np.asarray(gray, dtype=np.int16))
+            indexes.append((i, orientation))
+        except Exception:
+            continue
+    if not grids:
+        return results
+    grids = np.stack(grids)
+    bits = (grids[:, :, 1:] > grids[:, :, :-1]).reshape(len(grids), -1)
+    hashes = np.packbits(bits, axis=1).view('>u8').ravel()
+    for (i, orientation), value in zip(indexes, hashes.tolist()):
+        results[i] = (value, orientation)
+    return results
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+
+# BK 树：按汉明距离索引哈希，查询与给定哈希距离不超过 radius 的全部文件名
+class BKTree:
+    def __init__(self):
+        self.root = None  # 节点：[哈希, 文件名列表, {距离: 子节点}]
+
+    def add(self, value, name):
+        if self.root is None:
+            self.root = [value, [name], {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming_distance(value, node[0])
+            if distance == 0:
+                node[1].append(name)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, [name], {}]
+                return
+            node = child
+
+    def query(self, value, radius):
+        names = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming_distance(value, node[0])
+            if distance <= radius:
+                names.extend(node[1])
+            stack.extend(child for edge, child in node[2].items() if distance - radius <= edge <= distance + radius)
+        return names
+
+
+# 重复图片索引：后台线程把新加入队列的图片分批交给进程池计算感知哈希，结果放入 BK 树
+# 另一个后台线程为界面的当前图片查找重复图片，界面只读取缓存的结果，大目录中查询也不会卡住按键
+class DuplicateIndex:
+    def __init__(self, base_path, max_image_size, max_distance=DUPLICATE_DISTANCE, workers=DUPLICATE_WORKERS):
+        self.base_path = base_path
+        self.max_image_size = max_image_size
+        self.max_distance = max_distance
+        self.tree = BKTree()
+        self.hashes = {}  # 文件名 -> (哈希, EXIF 方向)
+        self.order = []  # 按算出哈希的顺序排列的文件名，查询结果据此增量更新
+        self.lock = threading.Lock()
+        self.pending = Queue()
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        self.target = None  # 需要查找重复图片的文件名
+        self.group = (None, [])  # 最近一次查询的 (文件名, 重复图片)
+        self.wakeup = threading.Event()
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        self.query_thread = threading.Thread(target=self._run_queries, daemon=True)
+        self.query_thread.start()
+
+    def add(self, names):
+        names = list(names)
+        if names:
+            self.pending.put(names)
+
+    def _run(self):
+        while True:
+            names = self.pending.get()
+            if names is None:
+                return
+            chunks = [names[i:i + HASH_CHUNK_SIZE] for i in range(0, len(names), HASH_CHUNK_SIZE)]
+            paths = [[os.path.join(self.base_path, name) for name in chunk] for chunk in chunks]
+            try:
+                for chunk, results in zip(chunks, self.executor.map(hash_images, paths, repeat(self.max_image_size))):
+                    with self.lock:
+                        for name, result in zip(chunk, results):
+                            if result is not None and name not in self.hashes:
+                                self.hashes[name] = result
+                                self.order.append(name)
+                                self.tree.add(result[0], name)
+                    self.wakeup.set()
+            except Exception:
+                # 进程池已关闭（程序退出）
+                return
+
+    # 请求在后台查找 name 的重复图片，结果通过 find 读取
+    def watch(self, name):
+        if name != self.target:
+            self.target = name
+            self.wakeup.set()
+
+    # 返回与 name 相似的其他图片（不含自身）；后台尚未查询完成或哈希尚未算出时返回空列表
+    def find(self, name):
+        group_name, names = self.group
+        return names if group_name == name else []
+
+    # 当前图片变化时在 BK 树中完整查询一次，之后只比较新算出的哈希
+    def _run_queries(self):
+        name = value = None
+        names = []
+        checked = 0
+        while True:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            if self.closed:
+                return
+            target = self.target
+            with self.lock:
+                if target != name:
+                    name, value, names, checked = target, None, [], 0
+                if value is None:
+                    entry = self.hashes.get(name)
+                    if entry is not None:
+                        value = entry[0]
+                        names = [other for other in self.tree.query(value, self.max_distance) if other != name]
+                        checked = len(self.order)
+                elif checked < len(self.order):
+                    new = self.order[checked:]
+                    checked = len(self.order)
+                    names = names + [other for other in new if other != name and
+                                     hamming_distance(self.hashes[other][0], value) <= self.max_distance]
+            self.group = (name, names)
+
+    # 只读取字典中的一项，不需要等待后台查询释放锁
+    def orientation(self, name):
+        entry = self.hashes.get(name)
+        return entry[1] if entry is not None else None
+
+    def close(self):
+        self.closed = True
+        self.wakeup.set()
+        self.pending.put(None)
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+# 按最近秩法计算已排序数据的百分位数
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, math.ceil(q / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+# 热路径耗时统计：按阶段保留最近的耗时，计算百分位数和每分钟分类张数，可导出为 Chrome trace 格式
+class LatencyTracker:
+    def __init__(self, trace=False):
+        self.lock = threading.Lock()
+        self.samples = {}  # 阶段 -> 最近 LATENCY_WINDOW 次耗时（秒）
+        self.classified = deque(maxlen=RATE_WINDOW)  # 最近几次分类完成的时间
+        self.trace = deque(maxlen=TRACE_MAX_EVENTS) if trace else None
+        self.origin = time.perf_counter()
+
+    @contextmanager
+    def measure(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, start, time.perf_counter())
+
+    def record(self, stage, start, end):
+        with self.lock:
+            if stage not in self.samples:
+                self.samples[stage] = deque(maxlen=LATENCY_WINDOW)
+            self.samples[stage].append(end - start)
+            if self.trace is not None:
+                self.trace.append((stage, start, end, threading.get_ident()))
+
+    def mark_classified(self):
+        self.classified.append(time.perf_counter())
+
+    # 按最近 RATE_WINDOW 次分类的间隔计算，暂停后恢复时很快回到真实速度
+    def images_per_minute(self):
+        if len(self.classified) < 2:
+            return 0.0
+        span = self.classified[-1] - self.classified[0]
+        return (len(self.classified) - 1) * 60 / span if span > 0 else 0.0
+
+    def summary(self):
+        with self.lock:
+            samples = {stage: sorted(values) for stage, values in self.samples.items()}
+        return {stage: {
+            'count': len(values),
+            'p50_ms': round(percentile(values, 50) * 1000, 2),
+            'p95_ms': round(percentile(values, 95) * 1000, 2),
+            'p99_ms': round(percentile(values, 99) * 1000, 2),
+        } for stage, values in samples.items()}
+
+    # 导出为 chrome://tracing / Perfetto 可打开的 JSON
+    def export(self, path):
+        with self.lock:
+            events = [{'name': stage, 'ph': 'X', 'pid': os.getpid(), 'tid': tid,
+                       'ts': round((start - self.origin) * 1e6), 'dur': round((end - start) * 1e6)}
+                      for stage, start, end, tid in (self.trace or ())]
+        data = {'traceEvents': events,
+                'otherData': {'summary': self.summary(), 'images_per_minute': round(self.images_per_minute(), 1)}}
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+
+# 类别管理功能
+def save_categories(categories):
+    with open("categories.json", "w", encoding="utf-8") as f:
+        json.dump(categories, f, ensure_ascii=False, indent=2)
+
+
+def load_categories():
+    if os.path.exists("categories.json"):
+        with open("categories.json", "r", encoding="utf-8") as f:
+            try:
+                return json.load(f)
+            except Exception:
+                return []
+    return []
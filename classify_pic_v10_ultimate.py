@@ -1,21 +1,28 @@
 import os
 import re
-import shutil
-import json
 import sys
 import tkinter as tk
 from tkinter import simpledialog, messagebox
 from PIL import Image, ImageTk
 import time
+import multiprocessing
 
-MAX_IMAGE_SIZE = (5000, 5000)
+from classify_pic_core import (
+    MAX_IMAGE_SIZE, DISPLAY_SIZE, PREFETCH_DEPTH, UNDO_MEMORY_MB, PREVIEW_CACHE_MB, ERROR_LOG_NAME, TRACE_NAME,
+    ClassifierEngine, save_categories, load_categories,
+)
 
-DISPLAY_SIZE = (900, 900)  # 固定的显示尺寸
+SCAN_POLL_MS = 50  # 界面读取扫描结果的间隔（毫秒）
 
+COMMIT_POLL_MS = 200  # 界面检查后台写入失败的间隔（毫秒）
 
-# 自定义异常
-class ImageTooLargeError(Exception):
-    pass
+REFINE_POLL_MS = 15  # 精细预览尚未完成时再次检查的间隔（毫秒）
+
+SESSION_SAVE_INTERVAL = 60  # 自动保存会话进度的间隔（秒）
+
+# 性能统计浮层显示的阶段：按键总耗时、等待预读取、生成 PhotoImage、提交（交给后台）、后台写入、回滚、弹窗
+STATS_STAGES = (('key', '按键'), ('load', '读取'), ('render', '渲染'), ('commit', '提交'), ('write', '写入'),
+                ('undo', '回滚'), ('dialog', '弹窗'))
 
 
 # 自定义对话框
@@ -46,30 +53,52 @@ class NoCancelDialog(simpledialog.Dialog):
         box.pack(pady=5)
 
 
-# 类别管理功能
-def save_categories(categories):
-    with open("categories.json", "w", encoding="utf-8") as f:
-        json.dump(categories, f, ensure_ascii=False, indent=2)
-
-
-def load_categories():
-    if os.path.exists("categories.json"):
-        with open("categories.json", "r", encoding="utf-8") as f:
-            try:
-                return json.load(f)
-            except Exception:
-                return []
-    return []
+# 显示区域：全屏 Canvas 上一张常驻的 PhotoImage，切换图片和旋转时只把预览图贴进同一块缓冲区
+# 不再每次新建 PhotoImage、重新布局 Label，也不会闪烁
+class DisplaySurface:
+    def __init__(self, root, size=DISPLAY_SIZE):
+        self.canvas = tk.Canvas(root, highlightthickness=0, bd=0)
+        self.canvas.place(x=0, y=0, relwidth=1, relheight=1)
+        # 缓冲区的留白与窗口背景同色，看起来和直接显示预览图一样
+        self.background = tuple(value // 257 for value in root.winfo_rgb(self.canvas['bg']))
+        self.frame = Image.new('RGB', size, self.background)
+        self.photo = ImageTk.PhotoImage(self.frame, master=root)
+        self.item = self.canvas.create_image(0, 0, image=self.photo, anchor='center', state='hidden')
+        self.canvas.bind('<Configure>', self.center)
+
+    def center(self, event):
+        self.canvas.coords(self.item, event.width // 2, event.height // 2)
+
+    def show(self, preview):
+        if preview.width > self.frame.width or preview.height > self.frame.height:
+            preview = preview.copy()
+            preview.thumbnail(self.frame.size, Image.LANCZOS)
+        if preview.mode not in ('RGB', 'RGBA'):
+            preview = preview.convert('RGBA' if 'transparency' in preview.info else 'RGB')
+        self.frame.paste(self.background, (0, 0) + self.frame.size)
+        box = ((self.frame.width - preview.width) // 2, (self.frame.height - preview.height) // 2)
+        self.frame.paste(preview, box, preview if preview.mode == 'RGBA' else None)
+        self.photo.paste(self.frame)
+        self.canvas.itemconfigure(self.item, state='normal')
+
+    def clear(self):
+        self.canvas.itemconfigure(self.item, state='hidden')
 
 
 # 图像分类功能
-def classify_images(base_path, target_base_path, custom_targets, max_image_size=(5000, 5000)):
-    images = [f for f in os.listdir(base_path) if f.lower().endswith(('png', 'jpg', 'jpeg', 'gif', 'bmp'))]
-    default_targets = ['有问题', '没有问题']
-    all_targets = custom_targets if custom_targets else default_targets
-
-    error_folder = os.path.join(target_base_path, 'error')
-    os.makedirs(error_folder, exist_ok=True)
+def classify_images(base_path, target_base_path, custom_targets, max_image_size=(5000, 5000),
+                    prefetch_depth=PREFETCH_DEPTH, prescan=False, undo_memory_mb=UNDO_MEMORY_MB, resume=True,
+                    recursive=False, verify=False, preview_cache_mb=PREVIEW_CACHE_MB, show_stats=False, trace=False):
+    # 预扫描需要完整的图片列表，此时在前台扫描目录
+    engine = ClassifierEngine(base_path, target_base_path, custom_targets, max_image_size, prefetch_depth,
+                              undo_memory_mb, preview_cache_mb, resume, recursive, background_scan=not prescan,
+                              trace=trace)
+    latency = engine.latency
+    all_targets = engine.targets
+
+    if prescan and not run_prescan(engine, verify):
+        engine.close(save=False)
+        return
 
     root = tk.Tk()
     root.title("图片分类")
@@ -80,14 +109,17 @@ def classify_images(base_path, target_base_path, custom_targets, max_image_size=
     # 禁止调整窗口大小
     root.resizable(False, False)
 
-    current_index = 0
-    history = []
-    current_image = None
-    tk_img = None
     key_buffer = ''
 
-    label = tk.Label(root)
-    label.place(x=0, y=0, relwidth=1, relheight=1)
+    # 关闭窗口后同一回调中剩余的控件更新都要跳过，否则 Tk 报 "application has been destroyed"
+    closed = False
+
+    def close_window():
+        nonlocal closed
+        closed = True
+        root.destroy()
+
+    surface = DisplaySurface(root)
 
     instructions = (
             "操作说明:\n"
@@ -99,7 +131,8 @@ def classify_images(base_path, target_base_path, custom_targets, max_image_size=
             "\n分类图片:\n"
             "输入数字(1-{})后按空格或回车确认\n".format(len(all_targets))
             + "\n".join(f"{i}: {target}" for i, target in enumerate(all_targets, 1))
-            + "\n\n0: 退出\n-: 回滚上一步\n退格键: 删除输入的数字"
+            + "\n\nF: 数字后按 F，把当前图片及其重复图片全部归入该类"
+            + "\n0: 退出\n-: 回滚上一步\nG: 跳转到第 N 张\nI: 显示/隐藏性能统计\n退格键: 删除输入的数字"
     )
     instruction_label = tk.Label(
         root, text=instructions, justify=tk.LEFT, font=("Arial", 14),
@@ -107,66 +140,126 @@ def classify_images(base_path, target_base_path, custom_targets, max_image_size=
     )
     instruction_label.place(relx=1.0, y=20, anchor='ne', x=-20)
 
-    # 图像处理功能
-    def load_image():
-        nonlocal current_image, tk_img, current_index
-        if current_index >= len(images):
-            messagebox.showinfo("完成", "所有图片已分类完成！")
-            root.destroy()
-            return
-        image_name = images[current_index]
-        image_path = os.path.join(base_path, image_name)
-        try:
-            with Image.open(image_path) as img:
-                current_image = img.copy()
-                if current_image.width > max_image_size[0] or current_image.height > max_image_size[1]:
-                    raise ImageTooLargeError(f"图像 {image_name} 超过最大尺寸限制")
-
-                # 保持原始图像不变，仅调整显示大小
-                display_img = current_image.copy()
-                display_img.thumbnail(DISPLAY_SIZE, Image.LANCZOS)
-                tk_img = ImageTk.PhotoImage(display_img)
-                label.config(image=tk_img)
-                root.title(f"分类图片：{image_name}  ({current_index + 1}/{len(images)})")
-        except ImageTooLargeError as e:
-            messagebox.showwarning("警告", str(e) + "，已移动到错误文件夹。")
-            shutil.move(image_path, os.path.join(error_folder, image_name))
-            images.pop(current_index)
+    # 坏图片计数，出现第一张坏图片时才显示
+    error_label = tk.Label(
+        root, text="", font=("Arial", 14),
+        bg='#FFFFFF', fg='red', bd=2, relief='solid', padx=10, pady=5
+    )
+
+    # 当前图片的近似重复图片数，后台算出哈希后才会出现，没有重复时隐藏
+    duplicate_label = tk.Label(
+        root, text="", font=("Arial", 14),
+        bg='#FFFFFF', fg='#1565C0', bd=2, relief='solid', padx=10, pady=5
+    )
+
+    def update_duplicates():
+        count = len(engine.find_duplicates()) if engine.images else 0
+        if count:
+            duplicate_label.config(text=f"重复图片：{count} 张（数字后按 F 全部归类）")
+            duplicate_label.place(x=20, rely=1.0, y=-70, anchor='sw')
+        else:
+            duplicate_label.place_forget()
+
+    def update_title():
+        stats = engine.stats()
+        if stats['remaining']:
+            total = f"{stats['total']}+" if stats['scanning'] else stats['total']
+            root.title(f"分类图片：{engine.current()}  ({stats['done'] + 1}/{total})")
+
+    def update_errors():
+        if engine.error_count:
+            error_label.config(text=f"已移入错误文件夹：{engine.error_count} 张（详见 {ERROR_LOG_NAME}）")
+            error_label.place(x=20, rely=1.0, y=-20, anchor='sw')
+
+    # 把后台扫描到的图片加入队列
+    def poll_scanner():
+        waiting = not engine.images
+        changed = engine.poll()
+        if engine.scanning:
+            root.after(SCAN_POLL_MS, poll_scanner)
+        if changed and waiting:
             load_image()
-            return
-        except Exception as e:
-            messagebox.showerror("错误", f"无法打开图像 {image_name}：{e}，已移动到错误文件夹。")
-            shutil.move(image_path, os.path.join(error_folder, image_name))
-            images.pop(current_index)
+        elif changed:
+            update_title()
+
+    # 报告后台写入失败的图片，这些图片已放回队尾；返回是否有失败
+    def report_commit_failures():
+        waiting = not engine.images
+        failed = engine.poll_commits()
+        if not failed:
+            return False
+        details = "\n".join(f"{name}：{error}" for name, error in failed[:10])
+        if len(failed) > 10:
+            details += f"\n……等共 {len(failed)} 张"
+        dialog(messagebox.showerror, "错误", f"保存图片失败，已放回队尾稍后重新分类：\n{details}")
+        if waiting:
             load_image()
-            return
+        else:
+            update_title()
         return True
 
-    def update_image():
-        nonlocal tk_img
-        if current_image is not None:
-            display_img = current_image.copy()
-            display_img.thumbnail(DISPLAY_SIZE, Image.LANCZOS)
-            tk_img = ImageTk.PhotoImage(display_img)
-            label.config(image=tk_img)
-
-    def rotate_image(direction):
-        nonlocal current_image
-        if current_image is not None:
-            if direction == 'left':
-                current_image = current_image.rotate(90, expand=True)
-            elif direction == 'right':
-                current_image = current_image.rotate(-90, expand=True)
-            update_image()
+    def poll_commits():
+        report_commit_failures()
+        if closed:
+            return
+        update_duplicates()
+        root.after(COMMIT_POLL_MS, poll_commits)
 
-    def flip_image(axis):
-        nonlocal current_image
-        if current_image is not None:
-            if axis == 'vertical':
-                current_image = current_image.transpose(Image.FLIP_TOP_BOTTOM)
-            elif axis == 'horizontal':
-                current_image = current_image.transpose(Image.FLIP_LEFT_RIGHT)
+    # 图像处理功能
+    def load_image():
+        # 引擎循环跳过无法显示的图片，连续的坏文件不会触发递归，也不弹窗
+        show_current(engine.load())
+
+    # 显示引擎准备好的当前图片；队列已空时等待扫描或结束分类
+    def show_current(loaded):
+        update_errors()
+        update_duplicates()
+        if loaded:
             update_image()
+            update_title()
+            if engine.refining is not None:
+                root.after_idle(refine_image, engine.generation)
+            return True
+
+        if engine.scanning:
+            # 已扫描到的图片已处理完，等待后台扫描出新的图片
+            surface.clear()
+            root.title("图片分类：正在扫描图片……")
+            return
+        # 等待最后几张写入完成，有失败的图片时继续分类
+        engine.writer.flush()
+        if report_commit_failures():
+            return
+        messagebox.showinfo("完成", "所有图片已分类完成！")
+        close_window()
+
+    def update_image():
+        if engine.current_display is not None:
+            with latency.measure('render'):
+                surface.show(engine.current_display)
+
+    # 空闲时用精细预览替换占位预览；操作员已切换到别的图片时直接放弃
+    # 完整文件无法解码时引擎已把它移入错误文件夹并准备好下一张
+    def refine_image(generation):
+        refined = engine.refine(generation)
+        if refined:
+            show_current(engine.display is not None)
+        elif refined is False:
+            root.after(REFINE_POLL_MS, refine_image, generation)
+
+    # 按键只改变引擎中的目标方向，空闲时统一绘制一次最新状态，连按时中间状态不再逐个绘制
+    render_pending = False
+
+    def transform_image(operation):
+        nonlocal render_pending
+        if engine.transform(operation) and not render_pending:
+            render_pending = True
+            root.after_idle(render_transform)
+
+    def render_transform():
+        nonlocal render_pending
+        render_pending = False
+        update_image()
 
     # 在创建instruction_label之后添加输入显示标签
     input_display = tk.Label(
@@ -175,9 +268,43 @@ def classify_images(base_path, target_base_path, custom_targets, max_image_size=
     )
     input_display.place(relx=0.5, y=50, anchor='n', x=-20, rely=0)
 
-    # 修改key_press函数如下：
+    # 性能统计浮层，放在输入显示标签下方，按 I 键切换
+    stats_display = tk.Label(
+        root, text="", font=("Consolas", 11), justify=tk.LEFT,
+        bg='white', fg='#333333', bd=1, relief='solid', padx=6, pady=4
+    )
+    stats_visible = show_stats
+
+    def update_stats():
+        if not stats_visible:
+            stats_display.place_forget()
+            return
+        summary = latency.summary()
+        lines = [f"{name:<6} p50 {summary[stage]['p50_ms']:7.1f}  p95 {summary[stage]['p95_ms']:7.1f}  "
+                 f"p99 {summary[stage]['p99_ms']:7.1f} ms"
+                 for stage, name in STATS_STAGES if stage in summary]
+        lines.append(f"速度   {latency.images_per_minute():.1f} 张/分钟")
+        stats_display.config(text="\n".join(lines))
+        stats_display.place(relx=0.5, y=100, anchor='n', x=-20, rely=0)
+
+    # 弹窗等待的时间单独统计，避免混入按键处理的耗时
+    def dialog(show, *args, **kwargs):
+        with latency.measure('dialog'):
+            return show(*args, **kwargs)
+
+    # 每次按键的总耗时，包括读取、渲染、提交和弹窗
     def key_press(event):
-        nonlocal current_index, current_image, key_buffer
+        nonlocal stats_visible
+        if event.char == 'i':
+            stats_visible = not stats_visible
+        else:
+            with latency.measure('key'):
+                handle_key(event)
+        if not closed:
+            update_stats()
+
+    def handle_key(event):
+        nonlocal key_buffer
         key = event.char
         lt = len(all_targets)
 
@@ -187,76 +314,117 @@ def classify_images(base_path, target_base_path, custom_targets, max_image_size=
 
         # 0键直接退出（放在最前面处理）
         if key == '0':
-            if messagebox.askyesno("退出", "确认退出分类吗？"):
-                root.destroy()
+            if dialog(messagebox.askyesno, "退出", "确认退出分类吗？"):
+                close_window()
             return
 
-        if current_index >= len(images):
+        if not engine.images:
             return
 
-        image_name = images[current_index]
-        image_path = os.path.join(base_path, image_name)
-
         # 处理数字输入
         if key.isdigit():
             key_buffer += key
             update_display()
             return
 
-        # 处理确认键（空格或回车）
-        if key in (' ', '\r') and key_buffer:
+        # 处理确认键（空格或回车），F 键同时归类全部重复图片
+        if key in (' ', '\r', 'f') and key_buffer:
             try:
                 idx = int(key_buffer)
                 if 1 <= idx <= lt:
-                    target_folder = os.path.join(target_base_path, all_targets[idx - 1])
-                    os.makedirs(target_folder, exist_ok=True)
-                    save_path = os.path.join(target_folder, image_name)
                     try:
-                        if current_image is not None:
-                            current_image.save(save_path)
-                        os.remove(image_path)
-                        history.append((image_path, save_path, current_image.copy()))
-                        images.pop(current_index)
+                        if key == 'f':
+                            loaded, _ = engine.classify_duplicates(idx)
+                        else:
+                            loaded = engine.classify(idx)
+                    except Exception as e:
+                        dialog(messagebox.showerror, "错误", f"保存图片失败: {e}")
+                    else:
                         key_buffer = ''
                         update_display()
-                        load_image()
-                    except Exception as e:
-                        messagebox.showerror("错误", f"保存图片失败: {e}")
+                        show_current(loaded)
                 else:
-                    messagebox.showerror("错误", f"请输入1-{lt}范围内的数字")
+                    dialog(messagebox.showerror, "错误", f"请输入1-{lt}范围内的数字")
                     key_buffer = ''
                     update_display()
             except ValueError:
-                messagebox.showerror("错误", "无效的数字输入")
+                dialog(messagebox.showerror, "错误", "无效的数字输入")
                 key_buffer = ''
                 update_display()
         elif key == '-':
-            if history:
-                last_image_path, last_save_path, last_img = history.pop()
-                shutil.move(last_save_path, last_image_path)
-                images.insert(current_index, os.path.basename(last_image_path))
-                current_image = last_img
+            try:
+                undone = engine.undo()
+            except Exception as e:
+                dialog(messagebox.showerror, "错误", f"回滚失败: {e}")
+                return
+            if undone:
                 update_image()
+                update_title()
             else:
-                messagebox.showinfo("提示", "没有更多图片可以回滚。")
+                dialog(messagebox.showinfo, "提示", "没有更多图片可以回滚。")
         elif key == 'a':
-            rotate_image('left')
+            transform_image('left')
         elif key == 'd':
-            rotate_image('right')
+            transform_image('right')
         elif key == 'w':
-            flip_image('vertical')
+            transform_image('vertical')
         elif key == 's':
-            flip_image('horizontal')
+            transform_image('horizontal')
+        elif key == 'g':
+            # 按扫描顺序跳转到任意一张图片
+            jump_dialog = dialog(NoCancelDialog, root, title="跳转",
+                                 prompt=f"跳转到第几张（1-{engine.stats()['scanned']}）：")
+            if jump_dialog.result is not None:
+                show_current(engine.jump(jump_dialog.result - 1))
         elif key == '\x08':  # 退格键
             key_buffer = key_buffer[:-1]
             update_display()
 
+    def autosave():
+        if engine.dirty:
+            engine.save_session()
+        root.after(SESSION_SAVE_INTERVAL * 1000, autosave)
+
     root.bind("<Key>", key_press)
+    if engine.repaired:
+        messagebox.showinfo("恢复", f"已处理上次中断时未完成的 {engine.repaired} 个操作，之前的分类仍可回滚。")
     load_image()
+    update_stats()
+    if engine.scanning:
+        root.after(SCAN_POLL_MS, poll_scanner)
+    root.after(COMMIT_POLL_MS, poll_commits)
+    root.after(SESSION_SAVE_INTERVAL * 1000, autosave)
     root.mainloop()
+    engine.close()
     save_categories(all_targets)
 
 
+# 预扫描并报告结果，可选择立即将问题图片移入错误文件夹；返回 False 表示取消分类
+def run_prescan(engine, verify=False):
+    scan_root = tk.Tk()
+    scan_root.withdraw()
+    rejected = engine.prescan(verify)
+    total = len(engine.images)
+    proceed = True
+    if rejected:
+        preview = "\n".join(f"{name}：{reason}" for name, reason in rejected[:10])
+        if len(rejected) > 10:
+            preview += f"\n……等共 {len(rejected)} 张"
+        answer = messagebox.askyesnocancel(
+            "预扫描结果",
+            f"共 {total} 张图片，其中 {len(rejected)} 张超过最大尺寸或已损坏：\n{preview}\n\n"
+            "是：立即移动到错误文件夹并开始分类\n否：保留原处并开始分类\n取消：退出",
+            parent=scan_root)
+        if answer is None:
+            proceed = False
+        elif answer:
+            engine.reject(rejected)
+    else:
+        messagebox.showinfo("预扫描结果", f"共 {total} 张图片，全部通过检查。", parent=scan_root)
+    scan_root.destroy()
+    return proceed
+
+
 # 用户界面相关功能
 def fade_in(window):
     for i in range(11):
@@ -317,14 +485,14 @@ def show_info_dialog(image_path):
 def prompt_for_paths():
     path_window = tk.Tk()
     path_window.title("输入路径和分类")
-    path_window.geometry("400x500")  # 设置固定大小
+    path_window.geometry("400x740")  # 设置固定大小
     path_window.resizable(False, False)  # 禁止调整窗口大小
     path_window.attributes("-alpha", 0)  # 初始透明度为0
 
     # 加载并调整图片大小
     image_path = resource_path('icon\\vergil.jpg')  # 替换为您的图片路径
 
-    center_window(path_window, 400, 500)
+    center_window(path_window, 400, 740)
 
     tk.Label(path_window, text="请使用双反斜杠（\\\\）或正斜杠（/）作为路径分隔符").pack(pady=5)
     tk.Label(path_window, text="输入待筛选图片的路径:").pack(pady=5)
@@ -350,6 +518,28 @@ def prompt_for_paths():
     if saved_categories:
         custom_categories_entry.insert(0, ','.join(saved_categories))
 
+    # 开始分类前先只读文件头预扫描全部图片
+    prescan_var = tk.BooleanVar(master=path_window, value=False)
+    tk.Checkbutton(path_window, text="开始前预扫描（统计超限/损坏图片）", variable=prescan_var).pack(pady=5)
+
+    # 预扫描时用 Image.verify() 检查截断的文件，较慢
+    verify_var = tk.BooleanVar(master=path_window, value=False)
+    tk.Checkbutton(path_window, text="预扫描时完整校验文件（较慢）", variable=verify_var).pack(pady=5)
+
+    # 继续上次保存的进度，不重新扫描目录
+    resume_var = tk.BooleanVar(master=path_window, value=True)
+    tk.Checkbutton(path_window, text="继续上次未完成的进度", variable=resume_var).pack(pady=5)
+
+    # 同时扫描子文件夹中的图片，分类后保留子文件夹结构
+    recursive_var = tk.BooleanVar(master=path_window, value=False)
+    tk.Checkbutton(path_window, text="包含子文件夹", variable=recursive_var).pack(pady=5)
+
+    # 显示各环节耗时，并在退出时把性能跟踪写入目标路径
+    stats_var = tk.BooleanVar(master=path_window, value=False)
+    tk.Checkbutton(path_window, text="显示性能统计（I 键切换）", variable=stats_var).pack(pady=5)
+    trace_var = tk.BooleanVar(master=path_window, value=False)
+    tk.Checkbutton(path_window, text=f"导出性能跟踪（{TRACE_NAME}）", variable=trace_var).pack(pady=5)
+
     # 在左下角添加文本并绑定点击事件
     info_label = tk.Label(path_window, text="源码链接", fg="blue", cursor="hand2")
     info_label.pack(side=tk.BOTTOM, anchor='sw', padx=10, pady=5)
@@ -382,8 +572,15 @@ def prompt_for_paths():
             messagebox.showerror("错误", "找不到目标路径")
             return
 
+        prescan = prescan_var.get()
+        verify = verify_var.get()
+        resume = resume_var.get()
+        recursive = recursive_var.get()
+        show_stats = stats_var.get()
+        trace = trace_var.get()
         path_window.destroy()
-        classify_images(base_path, target_base_path, custom_targets, max_image_size)
+        classify_images(base_path, target_base_path, custom_targets, max_image_size, prescan=prescan, resume=resume,
+                        recursive=recursive, verify=verify, show_stats=show_stats, trace=trace)
 
     tk.Button(path_window, text="确认", command=on_submit).pack(pady=20)
 
@@ -394,4 +591,6 @@ def prompt_for_paths():
 
 
 if __name__ == "__main__":
+    # 打包为 exe 后预扫描的子进程需要
+    multiprocessing.freeze_support()
     prompt_for_paths()
\ No newline at end of file